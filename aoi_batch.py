@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 14:31:05 2026
+
+@author: vpremier
+"""
+
+import os
+
+import geopandas as gpd
+import pandas as pd
+
+
+def read_aois(aois):
+    """
+    Read the AOIs of a batch job into a single GeoDataFrame (EPSG:4326), 
+    with one (dissolved) geometry per AOI.
+
+    Parameters
+    ----------
+    aois : list
+        list of dicts with at least 'name' and 'shapefile'
+
+    Returns
+    -------
+    aoi_gdf : gpd.GeoDataFrame
+        columns 'aoi' (name) and 'geometry'
+    """
+    frames = []
+    for aoi in aois:
+        gdf = gpd.read_file(aoi['shapefile'])
+        if not gdf.crs == 'EPSG:4326':
+            gdf = gdf.to_crs('EPSG:4326')
+        frames.append(gpd.GeoDataFrame({'aoi': [aoi['name']]},
+                                       geometry=[gdf.union_all()],
+                                       crs='EPSG:4326'))
+    aoi_gdf = pd.concat(frames, ignore_index=True)
+    return aoi_gdf
+
+
+
+def assign_products(products, aoi_gdf, footprints):
+    """
+    Assign each product of a merged query to the AOIs its footprint 
+    intersects. Products that do not intersect any AOI are dropped.
+    Products without a footprint (not returned by the server) cannot be 
+    checked: they are assigned to every AOI, and their number is printed.
+
+    Parameters
+    ----------
+    products : pd.DataFrame
+        query results (e.g. output of query_cdse or query_landsat)
+    aoi_gdf : gpd.GeoDataFrame
+        AOIs, as returned by read_aois
+    footprints : list-like
+        shapely footprints (EPSG:4326) of the products, in the same order
+        (None if unknown). If empty, no product has a footprint
+
+    Returns
+    -------
+    products : pd.DataFrame
+        the intersecting products (and those without a footprint), with a 
+        column 'aoi' that lists the names of the AOIs of each product
+    """
+    if products.empty:
+        products['aoi'] = []
+        return products
+
+    # footprints that are None or NaN are missing
+    footprints = [f if f is not None and f == f else None
+                  for f in (list(footprints) or [None] * len(products))]
+    missing = [i for i, f in enumerate(footprints) if f is None]
+
+    gdf = gpd.GeoDataFrame({'row': range(len(products))},
+                           geometry=footprints, crs='EPSG:4326')
+    pairs = gpd.sjoin(gdf[gdf.geometry.notna()], aoi_gdf[['aoi', 'geometry']],
+                      predicate='intersects')
+    aoi_lists = pairs.groupby('row')['aoi'].apply(list)
+
+    # no footprint: the product may cover any AOI
+    if missing:
+        aoi_lists = pd.concat([aoi_lists, pd.Series([list(aoi_gdf['aoi'])] * len(missing),
+                                                    index=missing)]).sort_index()
+        print(f"AOI assignment: {len(missing)} products without footprint "
+              f"assigned to all the AOIs")
+
+    products = products.iloc[aoi_lists.index].copy()
+    products['aoi'] = aoi_lists.values
+    
+    print(f"AOI assignment: {len(products) - len(missing)} products intersect "
+          f"{pairs['aoi'].nunique()}/{len(aoi_gdf)} AOIs "
+          f"({len(pairs)} product-AOI pairs)")
+
+    return products.reset_index(drop=True)
+
+
+
+def link_path(src, dst):
+    """
+    Materialize src at dst with a hard link (a symbolic link if src and dst
+    are on different filesystems). Folders are linked file by file.
+    Existing targets are left unchanged.
+    """
+    if os.path.isdir(src):
+        os.makedirs(dst, exist_ok=True)
+        with os.scandir(src) as entries:
+            for entry in entries:
+                link_path(entry.path, os.path.join(dst, entry.name))
+        return
+
+    if os.path.lexists(dst):
+        return
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    try:
+        os.link(src, dst)
+    except OSError:
+        os.symlink(os.path.abspath(src), dst)
+
+
+
+def materialize_products(outdir, aoi_outdir, rel_dirs, prefixes):
+    """
+    Link downloaded products from the shared download directory into the
+    layout of an AOI output directory.
+
+    Every entry of outdir/REL_DIR whose name starts with the product prefix
+    (e.g. the archive, a sparse SAFE folder or extracted Landsat bands) is 
+    linked into aoi_outdir/REL_DIR. Hidden (partial) entries are skipped.
+
+    Parameters
+    ----------
+    outdir : str
+        shared download directory
+    aoi_outdir : str
+        output directory of the AOI
+    rel_dirs : list
+        folder of each product relative to outdir 
+        (e.g. Sentinel2/T32TPS or Landsat/LC08/192028)
+    prefixes : list
+        name prefix of each product (e.g. S2 Name without .SAFE, Landsat
+        displayId)
+
+    Returns
+    -------
+    n_linked : int
+        number of products found and linked
+    """
+    if os.path.abspath(outdir) == os.path.abspath(aoi_outdir):
+        return len(prefixes)
+
+    n_linked = 0
+    for rel_dir, prefix in zip(rel_dirs, prefixes):
+        src_dir = os.path.join(outdir, rel_dir)
+        if not os.path.isdir(src_dir):
+            continue
+        found = False
+        with os.scandir(src_dir) as entries:
+            for entry in entries:
+                if entry.name.startswith(prefix) and not entry.name.startswith('.'):
+                    link_path(entry.path, os.path.join(aoi_outdir, rel_dir, entry.name))
+                    found = True
+        n_linked += found
+
+    return n_linked
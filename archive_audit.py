@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 11:02:45 2026
+
+@author: vpremier
+
+Integrity audit of the archives of an output directory:
+outdir/Sentinel2/TILE/*.zip and outdir/Landsat/SENSOR/PATHROW/*.tar.
+
+Zip files are checked through their central directory and the CRC of every
+entry, tar files through their headers (every member must be complete).
+The archives are checked in parallel on a process pool. Bad archives can be
+renamed to NAME.corrupt (or deleted), so that the next run downloads them
+again.
+
+Usage: python archive_audit.py OUTDIR [--workers N] [--quick]
+                               [--action report|requeue|delete] [--report FILE.csv]
+"""
+
+import argparse
+import os
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+
+ACTIONS = ['report', 'requeue', 'delete']
+
+
+def scan_archives(outdir):
+    """
+    List the archives of the output tree with os.scandir (one directory
+    listing per folder, no per-file stat).
+
+    Returns
+    -------
+    archives : list
+        paths of the Sentinel-2 zips and Landsat tars
+    """
+    archives = []
+
+    def walk(folder, depth, suffix):
+        try:
+            with os.scandir(folder) as entries:
+                for e in entries:
+                    if depth and e.is_dir(follow_symlinks=False):
+                        walk(e.path, depth - 1, suffix)
+                    elif not depth and e.name.endswith(suffix) and e.is_file():
+                        archives.append(e.path)
+        except FileNotFoundError:
+            pass
+
+    walk(os.path.join(outdir, 'Sentinel2'), 1, '.zip')
+    walk(os.path.join(outdir, 'Landsat'), 2, '.tar')
+    return archives
+
+
+
+def check_zip(path, quick=False):
+    """
+    Check a zip archive: readable central directory and, unless quick, the
+    CRC of every entry. Returns an error message or None.
+    """
+    try:
+        with zipfile.ZipFile(path) as z:
+            if quick:
+                # the entries must lie inside the file
+                size = os.path.getsize(path)
+                last = max(z.infolist(), key=lambda i: i.header_offset, default=None)
+                if last is not None and last.header_offset + last.compress_size > size:
+                    return 'truncated entry %s' % last.filename
+                return None
+            bad = z.testzip()
+            if bad is not None:
+                return 'bad CRC in %s' % bad
+    except (zipfile.BadZipFile, OSError, EOFError, ValueError) as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+
+def check_tar(path, quick=False):
+    """
+    Check a tar archive: every header is readable, the data of every
+    member lies inside the file and nothing is missing after the last 
+    member (truncated or interrupted transfers fail here). Returns an error
+    message or None.
+    """
+    try:
+        size = os.path.getsize(path)
+        n = 0
+        with tarfile.open(path, mode='r:') as tar:
+            for member in tar:
+                n += 1
+                if member.offset_data + member.size > size:
+                    return 'truncated member %s' % member.name
+            end = tar.offset
+        if n == 0:
+            return 'empty archive'
+        # a preallocated but interrupted transfer ends with zeros, which
+        # tarfile reads as the end-of-archive marker: more than a record of
+        # padding (10240 bytes) plus the marker means missing data
+        if size - end > tarfile.RECORDSIZE + 2 * tarfile.BLOCKSIZE:
+            return 'incomplete archive (%i bytes of zeros after the last member)' % (size - end)
+    except (tarfile.TarError, OSError, EOFError) as e:
+        return str(e) or type(e).__name__
+    return None
+
+
+
+def check_archive(path, quick=False):
+    """
+    Check one archive (zip or tar). Returns (path, size, error).
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError as e:
+        return path, 0, str(e)
+    if size == 0:
+        return path, 0, 'empty file'
+    if path.endswith('.zip'):
+        return path, size, check_zip(path, quick)
+    return path, size, check_tar(path, quick)
+
+
+
+def audit_archives(outdir, workers=None, quick=False, action='report'):
+    """
+    Audit the archives of an output directory on a process pool.
+
+    Parameters
+    ----------
+    outdir : str
+        output directory (with the Sentinel2/ and Landsat/ folders)
+    workers : int, optional
+        number of processes. Default is the number of CPUs
+    quick : bool, optional
+        only check the zip central directories (no CRC). Default is False
+    action : str, optional
+        what to do with the bad archives: 'report' (default), 'requeue'
+        (rename to NAME.corrupt, so that the next run downloads them again)
+        or 'delete'
+
+    Returns
+    -------
+    report : pandas.DataFrame
+        one row per archive: path, size, ok, error
+    """
+    if action not in ACTIONS:
+        raise ValueError(f"Invalid action: '{action}'. Allowed: {ACTIONS}.")
+
+    archives = scan_archives(outdir)
+    print(f"Auditing {len(archives)} archives in {outdir}")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(check_archive, archives, [quick] * len(archives),
+                             chunksize=8))
+
+    report = pd.DataFrame(rows, columns=['path', 'size', 'error'])
+    report['ok'] = report['error'].isna()
+
+    bad = report.loc[~report['ok'], 'path']
+    for path, error in zip(bad, report.loc[~report['ok'], 'error']):
+        print(f"BAD: {path} ({error})")
+        if action == 'requeue':
+            os.replace(path, path + '.corrupt')
+        elif action == 'delete':
+            os.remove(path)
+
+    print(f"Audit: {len(bad)}/{len(report)} bad archives"
+          + (f" ({action})" if len(bad) and action != 'report' else ''))
+
+    return report
+
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Integrity audit of the downloaded archives.")
+    parser.add_argument("outdir", help="output directory of the downloads")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes")
+    parser.add_argument("--quick", action="store_true", help="skip the zip CRC check")
+    parser.add_argument("--action", choices=ACTIONS, default='report',
+                        help="what to do with bad archives")
+    parser.add_argument("--report", help="save the audit as CSV")
+    args = parser.parse_args()
+
+    report = audit_archives(args.outdir, args.workers, args.quick, args.action)
+    if args.report:
+        report.to_csv(args.report, index=False)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 15:40:12 2026
+
+@author: vpremier
+
+Benchmark of the Sentinel-2 product filters on synthetic product tables:
+the chain get_filtered_baseline -> get_filtered_date -> filter_RON against
+the single-pass filter_products. Both must keep the same products.
+
+Usage: python benchmark_filters.py [n_rows ...]   (default 10000 100000 1000000)
+"""
+
+import contextlib
+import io
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from sentinel_filters import (filter_RON, filter_products, get_filtered_baseline,
+                              get_filtered_date)
+
+
+def synthetic_products(n, seed=0):
+    """
+    n Sentinel-2 products over 300 tiles and 143 orbits. About 10% of the
+    scenes are also published with an older baseline and 5% twice with the
+    same baseline (near-identical or partial footprints), as in the CDSE
+    catalogue.
+    """
+    rng = np.random.default_rng(seed)
+    n_scenes = int(n / 1.15)
+
+    tile = rng.integers(0, 300, n_scenes)
+    ron = rng.integers(1, 144, n_scenes)
+    day = pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.integers(0, 3000, n_scenes), 'D')
+    mission = np.where(rng.random(n_scenes) < 0.5, 'S2A', 'S2B')
+
+    scenes = pd.DataFrame({
+        'mission': mission,
+        'date': day.strftime('%Y%m%dT101031'),
+        'ron': ['R%03d' % r for r in ron],
+        'tile': ['T%02dTPS' % (t % 60 + 1) + str(t // 60) for t in tile],
+        'baseline': 'N0500',
+        'x': (tile % 60) * 6.0 - 180,
+        'y': (tile // 60) * 8.0,
+        'w': np.where(rng.random(n_scenes) < 0.3, 0.5, 1.0),
+    }).drop_duplicates(['mission', 'date', 'ron', 'tile'], ignore_index=True)
+
+    # older baselines and duplicated publications of other scenes (scenes
+    # with both are ambiguous for get_filtered_baseline, which keeps either)
+    old = scenes.sample(frac=0.10, random_state=seed).assign(baseline='N0400')
+    dup = scenes.drop(old.index).sample(frac=0.05 / 0.9, random_state=seed + 1)
+    dup = dup.assign(w=np.where(rng.random(len(dup)) < 0.5, dup['w'] * 0.99, dup['w'] * 0.5))
+    products = pd.concat([scenes, old, dup], ignore_index=True).iloc[:n]
+    generation = np.where(products.index < len(scenes), '20231011T134419', '20240101T000000')
+
+    products = products.assign(
+        Name=(products['mission'] + '_MSIL1C_' + products['date'] + '_' +
+              products['baseline'] + '_' + products['ron'] + '_' +
+              products['tile'] + '_' + generation + '.SAFE'),
+        cloudCover=rng.uniform(0, 100, len(products)),
+        footprint=shapely.box(products['x'], products['y'],
+                              products['x'] + products['w'], products['y'] + 1),
+    )
+    return products[['Name', 'cloudCover', 'footprint']].sample(frac=1, random_state=seed)
+
+
+
+def timed(func):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func()
+    return result, time.perf_counter() - start
+
+
+
+def run(n, RON_list):
+    products = synthetic_products(n)
+
+    def chain():
+        fltd = get_filtered_baseline(products.copy())
+        fltd = get_filtered_date(fltd)
+        return filter_RON(fltd, RON_list)
+
+    old, t_old = timed(chain)
+    new, t_new = timed(lambda: filter_products(products, RON_list=RON_list))
+
+    same = set(old['Name']) == set(new['Name'])
+    print(f"{n:>9} rows | chain {t_old:8.2f} s | filter_products {t_new:6.2f} s | "
+          f"x{t_old / t_new:5.1f} | {len(new)} kept | same result: {same}")
+
+
+
+if __name__ == "__main__":
+
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 1000000]
+    RON_list = ['R%03d' % r for r in range(1, 144, 2)]
+
+    for n in sizes:
+        run(n, RON_list)
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 10:14:36 2026
+
+@author: vpremier
+"""
+
+import os
+import socket
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+from shapely.geometry import box
+
+from product_store import get_md5
+from sentinel_filters import filter_products, get_min_cover
+
+
+# rows per parquet row group: the catalog is sorted by collection and date,
+# so the row group statistics act as a coarse temporal index
+ROW_GROUP_SIZE = 20000
+
+# a catalog lock older than this is left by a crashed process
+LOCK_STALE_SECONDS = 600
+
+
+def catalog_records(products, source):
+    """
+    Convert a query result to the catalog schema.
+
+    Parameters
+    ----------
+    products : pandas.DataFrame
+        raw result of query_cdse ('S2', Sentinel-2 OData products) or of
+        query_landsat ('Landsat', M2M scenes)
+    source : str
+        'S2' or 'Landsat'
+
+    Returns
+    -------
+    records : geopandas.GeoDataFrame
+        one row per product with the columns id, name, collection, mission,
+        date, published, cloud, baseline, orbit, tile, size, md5, updated
+        and the footprint as geometry (EPSG:4326)
+    """
+    if source == 'S2':
+        parts = products['Name'].str.split('_')
+        records = pd.DataFrame({
+            'id': products['Id'],
+            'name': products['Name'],
+            'collection': 'S2' + parts.str[1].str.replace('MSIL', 'MSI'),
+            'mission': products['Name'].str[:3],
+            'date': pd.to_datetime(parts.str[2], format='%Y%m%dT%H%M%S'),
+            'published': pd.to_datetime(products['PublicationDate'], utc=True),
+            'cloud': products.get('cloudCover', np.nan),
+            'baseline': parts.str[3],
+            'orbit': parts.str[4].str[1:].astype(int),
+            'tile': parts.str[5],
+            'size': products.get('ContentLength', np.nan),
+            'md5': [get_md5(c) for c in products['Checksum']]
+                   if 'Checksum' in products else None,
+        })
+        footprints = list(products['footprint'])
+    elif source == 'Landsat':
+        parts = products['displayId'].str.split('_')
+        records = pd.DataFrame({
+            'id': products['entityId'],
+            'name': products['displayId'],
+            'collection': products['displayId'].str[:4],
+            'mission': products['displayId'].str[:4],
+            'date': pd.to_datetime(parts.str[3], format='%Y%m%d'),
+            'published': pd.NaT,
+            'cloud': products.get('cloudCover', np.nan),
+            'baseline': parts.str[5],
+            'orbit': parts.str[2].str[:3].astype(int),
+            'tile': parts.str[2],
+            'size': np.nan,
+            'md5': None,
+        })
+        footprints = products['footprint'].tolist()
+    else:
+        raise ValueError(f"Unknown catalog source: '{source}'")
+
+    records['published'] = pd.to_datetime(records['published'], utc=True)
+    records['cloud'] = records['cloud'].astype(float)
+    records['size'] = records['size'].astype(float)
+    records['md5'] = records['md5'].astype('string')
+    records['updated'] = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    return gpd.GeoDataFrame(records, geometry=footprints, crs='EPSG:4326')
+
+
+
+@contextmanager
+def catalog_lock(catalog_path, stale_seconds=LOCK_STALE_SECONDS):
+    """
+    Exclusive lock of a catalog: the lock file CATALOG.lock is created with
+    O_EXCL, so that it also works between hosts on a shared filesystem. A
+    lock older than stale_seconds is taken over (renamed to a unique name 
+    and checked again before it is removed).
+    """
+    lock = catalog_path + '.lock'
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    while True:
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(owner)
+            break
+        except FileExistsError:
+            pass
+        try:
+            if time.time() - os.stat(lock).st_mtime > stale_seconds:
+                stale = f"{lock}.{uuid.uuid4().hex}.stale"
+                os.rename(lock, stale)
+                if time.time() - os.stat(stale).st_mtime > stale_seconds:
+                    print(f"Removing the stale catalog lock {lock}")
+                else:
+                    # a new lock was renamed: put it back
+                    try:
+                        os.link(stale, lock)
+                    except FileExistsError:
+                        pass
+                os.remove(stale)
+                continue
+        except FileNotFoundError:
+            continue
+        time.sleep(0.5)
+    try:
+        yield
+    finally:
+        try:
+            os.remove(lock)
+        except FileNotFoundError:
+            pass
+
+
+
+def update_catalog(catalog_path, products, source):
+    """
+    Upsert a query result into the local GeoParquet catalog. Products already
+    in the catalog (same id) are replaced by the new record. The catalog is
+    sorted by collection and date and written with a bbox covering column,
+    so that load_catalog can skip row groups by time and by space.
+
+    The read-modify-write runs under catalog_lock, so that concurrent 
+    queries (processes or hosts) do not lose each other's records.
+
+    Parameters
+    ----------
+    catalog_path : str
+        path of the GeoParquet file (created if it does not exist)
+    products : pandas.DataFrame
+        raw result of query_cdse or query_landsat
+    source : str
+        'S2' or 'Landsat'
+
+    Returns
+    -------
+    n : int
+        number of products in the catalog
+    """
+    if products is None or products.empty:
+        return 0
+
+    records = catalog_records(products, source)
+    os.makedirs(os.path.dirname(os.path.abspath(catalog_path)), exist_ok=True)
+
+    with catalog_lock(catalog_path):
+        if os.path.isfile(catalog_path):
+            records = pd.concat([gpd.read_parquet(catalog_path), records], ignore_index=True)
+
+        records = (records.drop_duplicates(subset='id', keep='last')
+                          .sort_values(['collection', 'date'])
+                          .reset_index(drop=True))
+
+        # write next to the catalog (unique name) and replace it atomically
+        tmp_path = f"{catalog_path}.{socket.gethostname()}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+        try:
+            records.to_parquet(tmp_path, index=False, write_covering_bbox=True,
+                               row_group_size=ROW_GROUP_SIZE)
+            os.replace(tmp_path, catalog_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    print(f"Catalog {catalog_path}: {len(records)} products")
+
+    return len(records)
+
+
+
+def load_catalog(catalog_path, collections, start, end, bounds=None):
+    """
+    Read the catalog rows of the given collections with start <= date < end
+    and, if bounds (minx, miny, maxx, maxy) are given, a footprint that
+    intersects them. Only the row groups that can match are read; the exact
+    spatial test uses the spatial index (STRtree) of the selection.
+    """
+    if not os.path.isfile(catalog_path):
+        raise FileNotFoundError(f"Catalog not found: '{catalog_path}'")
+
+    filters = [('collection', 'in', list(collections)),
+               ('date', '>=', pd.Timestamp(start)),
+               ('date', '<', pd.Timestamp(end))]
+    records = gpd.read_parquet(catalog_path, filters=filters, bbox=bounds)
+
+    if bounds is not None and not records.empty:
+        idx = records.sindex.query(box(*bounds), predicate='intersects')
+        records = records.iloc[np.sort(idx)]
+
+    return records.reset_index(drop=True)
+
+
+
+def read_aoi(shp):
+    """
+    AOI (shapefile path or GeoDataFrame) in EPSG:4326, or None.
+    """
+    if shp is None:
+        return None
+    if isinstance(shp, (str, os.PathLike)) and os.path.exists(shp):
+        gdf = gpd.read_file(shp)
+    elif isinstance(shp, gpd.GeoDataFrame):
+        gdf = shp
+    else:
+        raise ValueError(f"Unsupported input type for 'shp': {type(shp)}")
+    if gdf.crs is not None and gdf.crs.to_string() != 'EPSG:4326':
+        gdf = gdf.to_crs('EPSG:4326')
+    return gdf
+
+
+
+def query_catalog_cdse(catalog_path, date_start, date_end,
+                       data_collection = "S2MSI1C", shp = None,
+                       max_cc = 90, tile = None, filter_date = True,
+                       filter_baseline = True, RON_list = None,
+                       min_cover = None, min_baseline = None):
+    """
+    Offline version of query_cdse: the same query and filters, run against
+    the local catalog instead of the CDSE catalogue. No credentials needed.
+
+    Parameters
+    ----------
+    catalog_path : str
+        path of the GeoParquet catalog (see update_catalog)
+    date_start, date_end, data_collection, shp, max_cc, tile, filter_date,
+    filter_baseline, RON_list, min_cover, min_baseline :
+        see query_cdse
+
+    Returns
+    -------
+    products : pandas.DataFrame
+        matching products with the columns of query_cdse used downstream
+        (Id, Name, ContentLength, Checksum, PublicationDate, date,
+        cloudCover, footprint, tile)
+    """
+    gdf = read_aoi(shp)
+    bounds = tuple(gdf.total_bounds) if gdf is not None else None
+
+    records = load_catalog(catalog_path, [data_collection], date_start, date_end, bounds)
+    records = records[(records['date'] > pd.Timestamp(date_start)) &
+                      (records['cloud'] < max_cc)]
+
+    products = pd.DataFrame({
+        'Id': records['id'],
+        'Name': records['name'],
+        'ContentLength': records['size'],
+        'Checksum': records['md5'].astype(object).where(records['md5'].notna(), None),
+        'PublicationDate': records['published'],
+        'date': records['date'].dt.tz_localize('UTC'),
+        'cloudCover': records['cloud'],
+        'footprint': records.geometry.values,
+    }).reset_index(drop=True)
+
+    if not products.empty:
+        products = filter_products(products, baseline=filter_baseline,
+                                   footprint=filter_date, RON_list=RON_list,
+                                   tiles=tile, min_baseline=min_baseline)
+        if min_cover and gdf is not None and not products.empty:
+            groups = [f.split('_')[2][:8] + '_' + f.split('_')[4] for f in products['Name']]
+            products = get_min_cover(products, gdf.union_all(),
+                                     products['footprint'],
+                                     groups, coverage=min_cover)
+        products['tile'] = products['Name'].str.split('_').str[5]
+
+    print(f"Catalog: found {len(products)} {data_collection} products "
+          f"from {date_start} to {date_end} with maximum cloud coverage {max_cc}%")
+
+    return products
+
+
+
+def query_catalog_landsat(catalog_path, date_start, date_end, shp = None,
+                          max_cc = 90, sat = ['LT05','LE07','LC08','LC09'],
+                          min_cover = None, pathrowList = None, tierList = None):
+    """
+    Offline version of query_landsat, run against the local catalog.
+
+    Parameters
+    ----------
+    catalog_path : str
+        path of the GeoParquet catalog (see update_catalog)
+    date_start, date_end, shp, max_cc, sat, min_cover, pathrowList, tierList :
+        see query_landsat
+
+    Returns
+    -------
+    results : pd.DataFrame
+        displayId, entityId, cloudCover and footprint of the matching scenes
+    """
+    gdf = read_aoi(shp)
+    bounds = tuple(gdf.total_bounds) if gdf is not None else None
+    if not sat:
+        sat = ['LT05','LE07','LC08','LC09']
+
+    # the acquisition filter of M2M includes the end date
+    end = pd.Timestamp(date_end) + pd.Timedelta(days=1)
+    records = load_catalog(catalog_path, sat, date_start, end, bounds)
+    records = records[records['cloud'] <= max_cc]
+    if pathrowList:
+        records = records[records['tile'].isin(pathrowList)]
+    if tierList:
+        records = records[records['name'].str.split('_').str[6].isin(tierList)]
+
+    results = pd.DataFrame({
+        'displayId': records['name'],
+        'entityId': records['id'],
+        'cloudCover': records['cloud'],
+        'footprint': list(records.geometry),
+    }).reset_index(drop=True)
+
+    if min_cover and gdf is not None and not results.empty:
+        groups = [d.split('_')[3] + '_' + d.split('_')[2][:3] for d in results['displayId']]
+        results = get_min_cover(results, gdf.union_all(), results['footprint'],
+                                groups, coverage=min_cover)
+
+    print(f"Catalog: found {len(results)} Landsat scenes from {date_start} "
+          f"to {date_end} with maximum cloud coverage {max_cc}%")
+
+    return results
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 10:25:48 2026
+
+@author: vpremier
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+
+PRIORITIES = ['catalogue', 'cloud', 'newest', 'oldest', 'round_robin']
+
+
+def prioritize(queue, priority='catalogue', preferred_missions=None):
+    """
+    Order a download queue so that the most useful products come first.
+
+    Parameters
+    ----------
+    queue : pd.DataFrame
+        one row per product, with columns:
+        - date : acquisition date (sortable, e.g. 'YYYYMMDD')
+        - cloud : cloud cover in % (NaN if unknown)
+        - tile : S2 tile or Landsat path/row
+        - mission : e.g. 'S2A', 'LC09'
+    priority : str, optional
+        - 'catalogue' : keep the catalogue order (default)
+        - 'cloud' : lowest cloud cover first (then newest)
+        - 'newest' : most recent acquisitions first
+        - 'oldest' : oldest acquisitions first
+        - 'round_robin' : newest first, alternating between tiles
+    preferred_missions : list, optional
+        missions downloaded before all the others (in the given order)
+
+    Returns
+    -------
+    order : np.ndarray
+        positions of the rows of queue, in download order
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Invalid priority: '{priority}'. Allowed: {PRIORITIES}")
+
+    df = pd.DataFrame({'pos': np.arange(len(queue))})
+    keys = []
+
+    if preferred_missions:
+        rank = {m: i for i, m in enumerate(preferred_missions)}
+        df['mission_rank'] = [rank.get(m, len(rank)) for m in queue['mission']]
+        keys.append(('mission_rank', True))
+
+    date = queue['date'].to_numpy()
+    if priority == 'cloud':
+        df['cloud'] = pd.to_numeric(queue['cloud'], errors='coerce').to_numpy()
+        df['date'] = date
+        keys += [('cloud', True), ('date', False)]
+    elif priority == 'newest':
+        df['date'] = date
+        keys.append(('date', False))
+    elif priority == 'oldest':
+        df['date'] = date
+        keys.append(('date', True))
+    elif priority == 'round_robin':
+        # rank of each product within its tile (newest first), then tile
+        df['date'] = date
+        df['tile'] = queue['tile'].to_numpy()
+        df = df.sort_values('date', ascending=False, kind='stable')
+        df['turn'] = df.groupby('tile').cumcount()
+        keys += [('turn', True), ('tile', True)]
+
+    keys.append(('pos', True))
+    df = df.sort_values([k for k, _ in keys], ascending=[a for _, a in keys],
+                        kind='stable', na_position='last')
+
+    return df['pos'].to_numpy()
+
+
+
+def apply_budget(sizes, max_gb=None, max_products=None):
+    """
+    Limit an (already ordered) download queue to a byte and/or product 
+    budget. Products are taken in order while they fit in the budget.
+
+    Parameters
+    ----------
+    sizes : list-like
+        size in bytes of each product still to be downloaded
+    max_gb : float, optional
+        maximum volume to download, in GB
+    max_products : int, optional
+        maximum number of products to download
+
+    Returns
+    -------
+    keep : list
+        one bool per product: True if it is within the budget
+    """
+    keep = []
+    used = 0
+    n = 0
+    for size in sizes:
+        size = int(size) if size == size and size else 0
+        fits = ((max_products is None or n < max_products) and
+                (max_gb is None or used + size <= max_gb * 1024**3))
+        keep.append(fits)
+        if fits:
+            used += size
+            n += 1
+
+    if not all(keep):
+        print(f"Budget: {n} products ({used / 1024**3:.1f} GB) selected, "
+              f"{keep.count(False)} postponed")
+
+    return keep
+
+
+
+def deadline_passed(deadline):
+    """
+    Whether the wall-clock deadline (a time.time() value, or None) is over.
+    """
+    return deadline is not None and time.time() >= deadline
+
+
+
+class DownloadPostponed(Exception):
+    """
+    A download not started because the deadline is over.
+    """
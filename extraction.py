@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 16:20:09 2026
+
+@author: vpremier
+"""
+
+import multiprocessing
+import os
+import shutil
+import tarfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from inventory import mark_extracted
+
+
+def extract_archive(path, delete_archive=False):
+    """
+    Extract a downloaded archive next to it:
+    Sentinel2/TILE/NAME.zip -> Sentinel2/TILE/NAME.SAFE/ and
+    Landsat/SENSOR/PATHROW/SCENE.tar -> Landsat/SENSOR/PATHROW/SCENE_*.
+
+    The entries are first written to a hidden .NAME.partial folder and moved
+    in place only when the whole archive has been extracted, so that an
+    interrupted extraction never leaves an incomplete product. The product
+    is then marked as fully extracted ('*', see inventory.mark_extracted).
+
+    Parameters
+    ----------
+    path : str
+        path of the .zip or .tar archive
+    delete_archive : bool, optional
+        whether to delete the archive after a successful extraction
+
+    Returns
+    -------
+    entries : list
+        paths of the extracted top-level entries
+    """
+    dest_dir = os.path.dirname(path)
+    name = os.path.splitext(os.path.basename(path))[0]
+    partial_dir = os.path.join(dest_dir, '.' + name + '.partial')
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    os.makedirs(partial_dir)
+
+    try:
+        if path.endswith('.zip'):
+            with zipfile.ZipFile(path) as z:
+                z.extractall(partial_dir)
+        else:
+            with tarfile.open(path) as tar:
+                tar.extractall(partial_dir, filter='data')
+
+        entries = []
+        for entry in sorted(os.listdir(partial_dir)):
+            target = os.path.join(dest_dir, entry)
+            if os.path.isdir(target):
+                shutil.rmtree(target)
+            os.replace(os.path.join(partial_dir, entry), target)
+            entries.append(target)
+    finally:
+        shutil.rmtree(partial_dir, ignore_errors=True)
+    mark_extracted(dest_dir, name + '.SAFE' if path.endswith('.zip') else name, ['*'])
+
+    if delete_archive:
+        os.remove(path)
+
+    return entries
+
+
+
+class Extractor:
+    """
+    Post-download extraction stage. Archives handed over with submit() are
+    extracted on a process pool while the next downloads are still running
+    (decompression is CPU-bound, downloading is network-bound).
+
+    Parameters
+    ----------
+    workers : int, optional
+        number of extraction processes. Default is the number of CPUs
+    delete_archives : bool, optional
+        whether to delete each archive once extracted. Default is False
+    """
+    def __init__(self, workers=None, delete_archives=False):
+        self.delete_archives = delete_archives
+        # spawn: the downloads run in threads, which must not be forked
+        self.pool = ProcessPoolExecutor(max_workers=workers,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        self.futures = {}
+
+    def submit(self, path):
+        """
+        Queue an archive for extraction.
+        """
+        future = self.pool.submit(extract_archive, path, self.delete_archives)
+        self.futures[future] = path
+
+    def close(self):
+        """
+        Wait for the queued extractions.
+
+        Returns
+        -------
+        failed : list
+            paths of the archives that could not be extracted
+        """
+        failed = []
+        for future in as_completed(self.futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Extraction of {os.path.basename(self.futures[future])} failed: {e}")
+                failed.append(self.futures[future])
+        self.pool.shutdown()
+
+        print(f"Extracted {len(self.futures) - len(failed)}/{len(self.futures)} archives")
+        self.futures = {}
+
+        return failed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
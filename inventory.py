@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 25 10:06:44 2026
+
+@author: vpremier
+
+Inventory of the products already in an output directory, built with one
+os.scandir pass over outdir/Sentinel2/TILE/ and outdir/Landsat/SENSOR/PATHROW/
+instead of one os.path.exists / os.stat per product. The skip checks of
+the downloads become set lookups (isin) against the inventory.
+
+With a cache file, the entries of every product folder are saved together
+with the folder mtime: the next runs only list the folders whose mtime
+changed (downloads, extractions and deletions all change it, since files
+are renamed into place).
+
+Products extracted with band patterns (Landsat scenes, sparse Sentinel-2
+SAFE folders) get a hidden marker (.NAME.bands, see mark_extracted) listing
+the patterns already extracted, so that a product is downloaded again only
+for new patterns. Full extractions are marked with '*'.
+"""
+
+import json
+import os
+from fnmatch import fnmatch
+
+import numpy as np
+
+
+INVENTORY_VERSION = 2
+
+
+class Inventory:
+    """
+    Names (and sizes) of the entries of the product folders of outdir.
+
+    Parameters
+    ----------
+    outdir : str
+        output directory (with the Sentinel2/ and Landsat/ folders)
+    cache_path : str, optional
+        JSON file where the listing is cached between runs. If None, all
+        the folders are listed
+    """
+    def __init__(self, outdir, cache_path=None):
+        self.outdir = outdir
+        self.cache_path = cache_path
+
+        cached = self._load_cache()
+        folders = {}
+        listed = 0
+        for rel_dir, mtime in self._product_dirs():
+            entry = cached.get(rel_dir)
+            if entry is None or entry['mtime_ns'] != mtime:
+                entry = dict(self._list(rel_dir), mtime_ns=mtime)
+                listed += 1
+            folders[rel_dir] = entry
+
+        if cache_path and (listed or len(folders) != len(cached)):
+            self._save_cache(folders)
+
+        # name -> size (-1 for folders); names are unique product-wide
+        self.sizes = {name: size for entry in folders.values()
+                      for name, size in entry['entries']}
+        # members of the extracted Landsat scenes (SCENE_B3.TIF -> SCENE)
+        self.members = {}
+        for entry in folders.values():
+            for name, size in entry['entries']:
+                if name.startswith('L') and name.count('_') > 6:
+                    self.members.setdefault('_'.join(name.split('_')[:7]), []).append(name)
+        # band patterns already extracted, from the product markers
+        self.bands = {name: set(patterns) for entry in folders.values()
+                      for name, patterns in entry['bands'].items()}
+
+        print(f"Inventory of {outdir}: {len(self.sizes)} entries in "
+              f"{len(folders)} folders ({listed} listed)")
+
+    def _product_dirs(self):
+        # (relative path, mtime) of Sentinel2/TILE and Landsat/SENSOR/PATHROW
+        dirs = []
+
+        def walk(rel_dir, depth):
+            try:
+                with os.scandir(os.path.join(self.outdir, rel_dir)) as entries:
+                    for e in entries:
+                        if e.name.startswith('.') or not e.is_dir(follow_symlinks=False):
+                            continue
+                        if depth:
+                            walk(os.path.join(rel_dir, e.name), depth - 1)
+                        else:
+                            dirs.append((os.path.join(rel_dir, e.name),
+                                         e.stat(follow_symlinks=False).st_mtime_ns))
+            except FileNotFoundError:
+                pass
+
+        walk('Sentinel2', 0)
+        walk('Landsat', 1)
+        return dirs
+
+    def _list(self, rel_dir):
+        # [name, size] of the entries of a product folder (size -1 for
+        # folders) and the patterns of the scene markers; other hidden 
+        # (partial) entries are skipped
+        entries = []
+        bands = {}
+        with os.scandir(os.path.join(self.outdir, rel_dir)) as it:
+            for e in it:
+                if e.name.startswith('.') and e.name.endswith('.bands'):
+                    patterns = read_marker(e.path)
+                    if patterns is not None:
+                        bands[e.name[1:-len('.bands')]] = sorted(patterns)
+                    continue
+                if e.name.startswith('.') or e.name.endswith('.part'):
+                    continue
+                if e.is_dir():
+                    entries.append([e.name, -1])
+                elif e.name.endswith(('.zip', '.tar')):
+                    entries.append([e.name, e.stat().st_size])
+                else:
+                    entries.append([e.name, 0])
+        return {'entries': entries, 'bands': bands}
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.isfile(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if cache.get('version') != INVENTORY_VERSION or cache.get('outdir') != os.path.abspath(self.outdir):
+            return {}
+        return cache['folders']
+
+    def _save_cache(self, folders):
+        # replaced atomically, as the sync state
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': INVENTORY_VERSION, 'outdir': os.path.abspath(self.outdir),
+                       'folders': folders}, f)
+        os.replace(tmp_path, self.cache_path)
+
+    def has_file(self, names):
+        """
+        Whether each name is a non-empty file (e.g. NAME.zip, SCENE.tar).
+        """
+        return np.array([self.sizes.get(n, 0) > 0 for n in names], dtype=bool)
+
+    def has_dir(self, names):
+        """
+        Whether each name is a folder (e.g. an extracted NAME.SAFE).
+        """
+        return np.array([self.sizes.get(n) == -1 for n in names], dtype=bool)
+
+    def has_members(self, displayIds, band_patterns=None):
+        """
+        Whether each Landsat scene is extracted. With band_patterns, every
+        pattern must be listed in the scene marker or match one of its 
+        members (SCENE_*); without, any member is enough (full extraction).
+        """
+        def extracted(displayId):
+            members = self.members.get(displayId, [])
+            if not band_patterns:
+                return bool(members)
+            marked = self.bands.get(displayId, set())
+            return all('*' in marked or p in marked or any(fnmatch(m, p) for m in members)
+                       for p in band_patterns)
+
+        return np.array([extracted(d) for d in displayIds], dtype=bool)
+
+    def has_bands(self, names, band_patterns):
+        """
+        Whether each product folder (e.g. a sparse NAME.SAFE) exists and 
+        its marker lists every one of band_patterns (or '*').
+        """
+        def extracted(name):
+            marked = self.bands.get(name, set())
+            return (self.sizes.get(name) == -1 and
+                    ('*' in marked or all(p in marked for p in band_patterns)))
+
+        return np.array([extracted(n) for n in names], dtype=bool)
+
+
+
+def read_marker(path):
+    """
+    Band patterns listed in a scene marker, or None if it cannot be read.
+    """
+    try:
+        with open(path, 'r') as f:
+            return set(json.load(f))
+    except (OSError, ValueError, TypeError):
+        return None
+
+
+
+def mark_extracted(dest_dir, name, band_patterns):
+    """
+    Record the band_patterns extracted for a product (Landsat displayId or
+    Sentinel-2 NAME.SAFE) in the hidden marker dest_dir/.NAME.bands (merged
+    with the patterns of earlier extractions). A pattern that matched no
+    member of the product stays recorded, so the product is not downloaded
+    again for it.
+    """
+    path = os.path.join(dest_dir, '.' + name + '.bands')
+    patterns = set(band_patterns) | (read_marker(path) or set())
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(sorted(patterns), f)
+    os.replace(tmp_path, path)
@@ -13,10 +13,25 @@ import cgi
 import json
 import sys
 import time
+import shutil
+import tarfile
 
+from datetime import datetime, timezone
+from fnmatch import fnmatch
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shapely.geometry import shape
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from product_store import clone_file, store_add, store_lookup
+from transfer import (ConcurrencyTuner, DiskWriter, fetch_to_file, plan_downloads,
+                      preallocate)
+from download_queue import DownloadPostponed, apply_budget, deadline_passed, prioritize
+from sentinel_filters import get_min_cover
+from catalog import update_catalog
+from inventory import Inventory, mark_extracted
+
 
 def sendRequest(url, data, apiKey = None, exitIfNoResponse = True):
     """
@@ -76,6 +91,96 @@ def sendRequest(url, data, apiKey = None, exitIfNoResponse = True):
 
 
 
+def iter_scene_search(serviceUrl, apiKey, scene_search, page_size=5000):
+    """
+    Run an M2M scene-search page by page (startingNumber / nextRecord) and
+    yield the scenes of each page. The next page is requested in the 
+    background while the caller processes the current one.
+
+    Parameters
+    ----------
+    serviceUrl : str
+        M2M service URL
+    apiKey : str
+        M2M API key
+    scene_search : dict
+        scene-search payload (datasetName, sceneFilter, ...)
+    page_size : int, optional
+        scenes per request (maxResults). Default is 5000
+
+    Yields
+    ------
+    scenes : list
+        the 'results' of a page
+    """
+    def request(startingNumber):
+        payload = dict(scene_search, maxResults=page_size, startingNumber=startingNumber)
+        return startingNumber, sendRequest(serviceUrl + "scene-search", payload, apiKey)
+    
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = executor.submit(request, 1)
+        while pending is not None:
+            start, page = pending.result()
+            
+            # prefetch the next page
+            nextRecord = page.get('nextRecord')
+            more = (page.get('recordsReturned', len(page['results'])) > 0 and 
+                    nextRecord and start < nextRecord <= page.get('totalHits', 0))
+            pending = executor.submit(request, nextRecord) if more else None
+            
+            print(f"  {scene_search['datasetName']}: "
+                  f"{start - 1 + len(page['results'])}/{page.get('totalHits', '?')} scenes")
+            yield page['results']
+
+
+
+def get_metadata_filter(serviceUrl, apiKey, datasetName, satellites=None,
+                        pathrowList=None, tierList=None):
+    """
+    Build an M2M metadataFilter for a dataset from the satellites 
+    (e.g. ['9'] for LC09), path/rows (e.g. ['192028']) and collection tiers
+    (e.g. ['T1']) to keep. The ids of the 'Satellite', 'WRS Path', 'WRS Row'
+    and 'Collection Category' fields are read from dataset-filters; the
+    conditions on fields that the dataset does not have are left out (the
+    caller must also filter the results). Returns None if there is no
+    condition.
+    """
+    filters = sendRequest(serviceUrl + "dataset-filters", {'datasetName': datasetName}, 
+                          apiKey, exitIfNoResponse=False)
+    fieldIds = {str(f.get('fieldLabel', '')).strip().lower(): f['id'] for f in (filters or [])}
+    
+    def value(field, v):
+        return {'filterType': 'value', 'filterId': fieldIds[field], 'value': v, 'operand': '='}
+    
+    def between(field, v):
+        # numeric comparison: independent of the zero padding of the values
+        return {'filterType': 'between', 'filterId': fieldIds[field],
+                'firstValue': int(v), 'secondValue': int(v)}
+    
+    def any_of(childFilters):
+        if len(childFilters) == 1:
+            return childFilters[0]
+        return {'filterType': 'or', 'childFilters': childFilters}
+    
+    conditions = []
+    if satellites and 'satellite' in fieldIds:
+        conditions.append(any_of([value('satellite', v) for v in satellites]))
+    if pathrowList and 'wrs path' in fieldIds and 'wrs row' in fieldIds:
+        conditions.append(any_of([{'filterType': 'and', 
+                                   'childFilters': [between('wrs path', pr[:3]), 
+                                                    between('wrs row', pr[3:])]}
+                                  for pr in pathrowList]))
+    if tierList and 'collection category' in fieldIds:
+        conditions.append(any_of([value('collection category', t) for t in tierList]))
+    
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'filterType': 'and', 'childFilters': conditions}
+
+
+
 def prompt_ERS_login(serviceURL, username, token):
     """
     Log in to the EROS Registration Service (ERS)
@@ -152,7 +257,9 @@ def downloadfiles(download):
 
 
 def query_landsat(date_start, date_end, username, token, shp = None,
-                         max_cc = 90, sat = ['LT05','LE07','LC08','LC09']):
+                         max_cc = 90, sat = ['LT05','LE07','LC08','LC09'],
+                         ingested_after = None, min_cover = None, catalog = None,
+                         pathrowList = None, tierList = None):
     
     """Returns list of matching Landsat scenes for a selected period and
         for a specific area (defined from a shapefile). The username and
@@ -181,17 +288,39 @@ def query_landsat(date_start, date_end, username, token, shp = None,
     sat : list, optional
         list with desired missions. If not specified, all matching missions are selected. 
         Possible options are LT05, LE07, LC08 and LC09
+    ingested_after : str, optional
+        only return scenes ingested in the USGS archive after this date
+        (e.g. '2025-03-31'). Used for the delta sync
+    min_cover : float, optional
+        if given (e.g. 0.99), keep for each date and path only the smallest
+        set of scenes that covers this fraction of the AOI (see 
+        sentinel_filters.get_min_cover). Only with a shapefile
+    catalog : str, optional
+        path of a local GeoParquet catalog. The scenes found are upserted 
+        into it and can be queried offline with catalog.query_catalog_landsat
+    pathrowList : list, optional
+        path/rows (str, e.g. '192028') to keep. Sent to M2M as a metadata
+        filter (and checked on the results)
+    tierList : list, optional
+        collection tiers (str, e.g. 'T1') to keep. Sent to M2M as a metadata
+        filter (and checked on the results)
     
     Returns
     -------
     results : pd.DataFrame that contains:
             - displayId
             - entityId
+            - cloudCover
+            - footprint (shapely geometry, EPSG:4326)
+        results.attrs['watermark'] holds the (UTC) time of the query
     """
     
     
     serviceUrl = "https://m2m.cr.usgs.gov/api/api/json/stable/"
     
+    # next delta sync starts from the time of this query
+    watermark = datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    
     # log in
     apiKey = prompt_ERS_login(serviceUrl, username, token)    
     
@@ -201,6 +330,9 @@ def query_landsat(date_start, date_end, username, token, shp = None,
                  'LE07':'landsat_etm_c2_l1',
                  'LC08':'landsat_ot_c2_l1',
                  'LC09':'landsat_ot_c2_l1'}
+    
+    # value of the 'Satellite' metadata field of each satellite
+    spacecraft = {'LT05':'5', 'LE07':'7', 'LC08':'8', 'LC09':'9'}
      
     if shp is None:          
         # Bounding Box Coordinates
@@ -234,50 +366,74 @@ def query_landsat(date_start, date_end, username, token, shp = None,
     if sat == []:
         sat = ['LT05','LE07','LC08','LC09']
         
-    # Request
-    results = []
+    # one search per dataset (LC08 and LC09 share landsat_ot_c2_l1)
+    datasets = {}
     for key in satellite:
+        if key in sat:
+            datasets.setdefault(satellite[key], []).append(key)
+    
+    # filter by date
+    acquisitionFilter = {'start' : date_start, 'end' : date_end}
+    
+    # filter spatially
+    spatialFilter =  {'filterType' : 'mbr',
+                       'lowerLeft' : {'latitude' : lat_min,\
+                                      'longitude' : lon_min},
+                      'upperRight' : { 'latitude' : lat_max,\
+                                      'longitude' : lon_max}}
+    
+    def keep_scene(displayId, keys):
+        fields = displayId.split('_')
+        return (fields[0] in keys and 
+                (not pathrowList or fields[2] in pathrowList) and 
+                (not tierList or fields[6] in tierList))
+    
+    def search(datasetName, keys):
         
-        if key not in sat:
-            continue
-        
-        # filter by date
-        acquisitionFilter = {'start' : date_start, 'end' : date_end}
-        
-        # filter spatially
-        spatialFilter =  {'filterType' : 'mbr',
-                           'lowerLeft' : {'latitude' : lat_min,\
-                                          'longitude' : lon_min},
-                          'upperRight' : { 'latitude' : lat_max,\
-                                          'longitude' : lon_max}}
-            
-            
-        scene_search  = {'datasetName': satellite[key],
-                         'maxResults':10000, # default is 100
+        scene_search  = {'datasetName': datasetName,
                             'sceneFilter' : {
                                 'spatialFilter': spatialFilter,
                                 'cloudCoverFilter' : {'min' : 0, 'max' : max_cc},
                                 'acquisitionFilter' : acquisitionFilter,}
                             }
 
-        # send request
-        scenes  = sendRequest(serviceUrl + "scene-search", scene_search, apiKey)
-        
-
-        for result in scenes['results']:
-            # Add this scene to the list I would like to download
-            results.append({
-                'displayId': result['displayId'],
-                'entityId': result['entityId']
-            })
-        
-    # After the loop:
-    unique_results = {}
-    for r in results:
-        unique_results[r['displayId']] = r  # Keep only the last occurrence
+        # filter by spacecraft (only some satellites of the dataset), 
+        # path/row and tier on the server
+        satellites = None
+        if len(keys) < list(satellite.values()).count(datasetName):
+            satellites = [spacecraft[k] for k in keys]
+        if satellites or pathrowList or tierList:
+            metadataFilter = get_metadata_filter(serviceUrl, apiKey, datasetName,
+                                                 satellites, pathrowList, tierList)
+            if metadataFilter:
+                scene_search['sceneFilter']['metadataFilter'] = metadataFilter
+
+        # delta sync: only scenes ingested after the watermark
+        if ingested_after:
+            scene_search['sceneFilter']['ingestFilter'] = {'start': ingested_after[:10],
+                                                           'end': watermark[:10]}
+
+        # send requests (one per page of results)
+        scenes = []
+        for page in iter_scene_search(serviceUrl, apiKey, scene_search):
+            # satellite, path/row and tier are also checked here, in case 
+            # the server-side filter is not available
+            scenes.extend({'displayId': result['displayId'],
+                           'entityId': result['entityId'],
+                           'cloudCover': result.get('cloudCover'),
+                           'footprint': (shape(result['spatialCoverage'])
+                                         if result.get('spatialCoverage') else None)}
+                          for result in page if keep_scene(result['displayId'], keys))
+        return scenes
     
-    results = list(unique_results.values())
-            
+    # Request: the dataset searches run concurrently
+    with ThreadPoolExecutor(max_workers=max(len(datasets), 1)) as executor:
+        found = list(executor.map(lambda item: search(*item), datasets.items()))
+    
+    # a scene returned by several pages or searches is kept once
+    results = [r for scenes in found for r in scenes]
+    results = list({r['entityId']: r for r in results}.values())
+        
         
     landsat_sensor = [r['displayId'].split('_')[0] for r in results]
     landsat_sensor = list(dict.fromkeys(landsat_sensor))  
@@ -303,12 +459,31 @@ def query_landsat(date_start, date_end, username, token, shp = None,
 
     
 
-    return pd.DataFrame(results)
+    results = pd.DataFrame(results)
+    
+    # keep the scenes in the local catalog for offline queries
+    if catalog and not results.empty:
+        update_catalog(catalog, results, 'Landsat')
+    
+    # Minimal set of scenes covering the AOI (per date and path)
+    if min_cover and shp is not None and not results.empty:
+        groups = [d.split('_')[3] + '_' + d.split('_')[2][:3] for d in results['displayId']]
+        results = get_min_cover(results, gdf.union_all(), results['footprint'],
+                                groups, coverage=min_cover)
+    
+    results.attrs['watermark'] = watermark
+
+    return results
 
 
 
 def download_landsat(results, outdir, username, token,
-                     pathrowList=None, tierList=None):
+                     pathrowList=None, tierList=None, max_workers=4,
+                     band_patterns=None, keep_tar=False, store_dir=None,
+                     reserve_gb=None, priority='catalogue', preferred_missions=None,
+                     max_gb=None, max_products=None, deadline=None,
+                     concurrency=None, extractor=None, segments=1,
+                     disk_writer=None, inventory=None, postponed=None):
     
     """Downloads a list of Landsat given as input. Possibility to filter 
         by tile and tier. The same credentials as function 
@@ -317,6 +492,10 @@ def download_landsat(results, outdir, username, token,
         Downloads Landsat scenes and saves them in a structured folder:
         outdir/Landsat/SENSOR/TILE/SCENE.tar
         
+        If band_patterns is given, the tar members matching the patterns 
+        are extracted from the HTTP stream as they arrive and saved as 
+        outdir/Landsat/SENSOR/TILE/MEMBER (e.g. SCENE_B3.TIF).
+        
     
     Parameters
     ----------
@@ -333,10 +512,75 @@ def download_landsat(results, outdir, username, token,
         path/row (str) to download    
     tierList : list, optional
         tiers (str) to download 
+    max_workers : int, optional
+        number of scenes downloaded in parallel. Each URL is handed to the
+        pool as soon as download-retrieve returns it. Default is 4
+    band_patterns : list, optional
+        glob patterns (str) of the tar members to keep, e.g. 
+        ['*_B3.TIF', '*_B6.TIF', '*_MTL.txt']. If None or empty, the full
+        tar is saved
+    keep_tar : bool, optional
+        whether to save the full tar alongside the extracted members.
+        Only used with band_patterns. Default is False
+    store_dir : str, optional
+        root of a global product store shared by several output directories.
+        Scenes whose tar is in the store are hard-linked (or reflinked), or
+        extracted locally with band_patterns, instead of downloaded. 
+        Downloaded tars are added to the store
+    reserve_gb : float, optional
+        if given, the expected download volume (M2M filesize) is compared
+        with the free space in outdir and the queue is limited to the scenes
+        that fit, keeping reserve_gb GB free. The other scenes are postponed
+        (and returned as failed)
+    priority : str, optional
+        download order: 'catalogue' (default), 'cloud', 'newest', 'oldest'
+        or 'round_robin' (per path/row). See download_queue.prioritize
+    preferred_missions : list, optional
+        missions (e.g. ['LC09', 'LC08']) downloaded before the others
+    max_gb : float, optional
+        maximum volume to download in this run, in GB
+    max_products : int, optional
+        maximum number of scenes to download in this run
+    deadline : float, optional
+        wall-clock deadline (time.time() value). No new download is started
+        after it
+    concurrency : dict, optional
+        adaptive concurrency, e.g. {'min': 1, 'max': 8, 'start': 2}: the
+        number of parallel downloads follows the measured throughput and 
+        backs off on throttling (see transfer.ConcurrencyTuner). If None,
+        max_workers downloads run in parallel
+    extractor : extraction.Extractor, optional
+        post-download extraction stage: every tar is extracted on a process
+        pool (into Landsat/SENSOR/TILE/) while the next scenes download.
+        Extracted scenes count as downloaded. Not used with band_patterns
+    segments : int, optional
+        number of parallel connections (byte ranges) per tar, for large
+        tars whose single stream is slower than the link. Not used with 
+        band_patterns. Default is 1
+    disk_writer : dict, optional
+        writer stage decoupled from the network reads, e.g. 
+        {'threads': 2, 'buffer_mb': 256} (see transfer.DiskWriter). Not 
+        used with band_patterns
+    inventory : inventory.Inventory, optional
+        listing of outdir used to skip the scenes already downloaded or
+        extracted. If None, outdir is scanned once (no per-scene stat)
+    postponed : list, optional
+        if given, the displayIds of the scenes postponed (budgets, disk 
+        reserve, deadline) are appended to it. They are also returned as
+        failed
+    
+    Returns
+    -------
+    failed : list
+        displayIds of the scenes that could not be downloaded
     
     """
 
 
+    if results.empty:
+        print("No Landsat scenes to download.")
+        return []
+
     serviceUrl = "https://m2m.cr.usgs.gov/api/api/json/stable/"
     apiKey = prompt_ERS_login(serviceUrl, username, token)
 
@@ -353,15 +597,23 @@ def download_landsat(results, outdir, username, token,
     results['pathrow'] = results['displayId'].str.split('_').str[2]
     results['tier'] = results['displayId'].str.split('_').str[-1]
 
-    # Mark already downloaded
-    def is_downloaded(row):
-        sensor = row['satellite']
-        tile = row['pathrow']
-        filename = row['displayId'] + '.tar'
-        filepath = os.path.join(outdir, 'Landsat', sensor, tile, filename)
-        return os.path.exists(filepath)
+    # Mark already downloaded (one scan of the output tree)
+    if inventory is None:
+        inventory = Inventory(outdir)
+    has_tar = inventory.has_file(results['displayId'] + '.tar')
+    has_members = inventory.has_members(results['displayId'], band_patterns)
+    if band_patterns and not keep_tar:
+        results['already_downloaded'] = has_members
+    else:
+        # tars (or extracted, and deleted, tars) of previous runs
+        results['already_downloaded'] = has_tar | (has_members & (extractor is not None))
+    
+    # tars of previous runs not extracted yet
+    if extractor is not None and not band_patterns:
+        for row in results[has_tar & ~has_members].itertuples():
+            extractor.submit(os.path.join(outdir, 'Landsat', row.satellite, row.pathrow,
+                                          row.displayId + '.tar'))
 
-    results['already_downloaded'] = results.apply(is_downloaded, axis=1)
     filtered = results[~results['already_downloaded']].copy()
 
     # Apply optional filters
@@ -371,11 +623,49 @@ def download_landsat(results, outdir, username, token,
         filtered = filtered[filtered['tier'].isin(tierList)]
 
     print(f"Already downloaded: {results['already_downloaded'].sum()} scenes")
+    
+    # Materialize the scenes available in the global store
+    if store_dir and not filtered.empty:
+        in_store = []
+        for row in filtered.itertuples():
+            stored = store_lookup(store_dir, 'landsat', row.displayId, row.displayId + '.tar')
+            if not stored:
+                continue
+            dest_dir = os.path.join(outdir, 'Landsat', row.satellite, row.pathrow)
+            os.makedirs(dest_dir, exist_ok=True)
+            if band_patterns:
+                with open(stored, 'rb') as f:
+                    extract_tar_stream(f, dest_dir, row.displayId, band_patterns)
+            if not band_patterns or keep_tar:
+                clone_file(stored, os.path.join(dest_dir, row.displayId + '.tar'))
+            if extractor is not None and not band_patterns:
+                extractor.submit(os.path.join(dest_dir, row.displayId + '.tar'))
+            in_store.append(row.Index)
+        filtered = filtered.drop(index=in_store)
+        print(f"Taken from the product store: {len(in_store)} scenes")
+    
     print(f"To download: {len(filtered)} scenes")
 
 
 
-    # Loop over satellite groups
+    # Priority order of the queue
+    queue = pd.DataFrame({
+        'date': filtered['displayId'].str.split('_').str[3],
+        'cloud': filtered['cloudCover'] if 'cloudCover' in filtered else float('nan'),
+        'tile': filtered['pathrow'],
+        'mission': filtered['satellite'],
+    })
+    filtered = filtered.iloc[prioritize(queue, priority, preferred_missions)]
+    rank = {entityId: r for r, entityId in enumerate(filtered['entityId'])}
+
+    # Index scenes by entityId: entityId -> (sensor, pathrow, displayId)
+    scene_index = {
+        row.entityId: (row.satellite, row.pathrow, row.displayId)
+        for row in filtered.itertuples(index=False)
+    }
+
+    # Download options for every satellite group
+    options = []
     for sat_id, group_df in filtered.groupby('satellite'):
         dataset_name = satellite.get(sat_id)
         if not dataset_name:
@@ -394,14 +684,64 @@ def download_landsat(results, outdir, username, token,
         for product in downloadOptions:
             if product['available'] and product['downloadSystem'] == 'ls_zip':
                 availableproducts.append({
+                    'satellite': sat_id,
                     'entityId': product['entityId'],
-                    'productId': product['id']
+                    'productId': product['id'],
+                    'filesize': product.get('filesize', 0)
                 })
 
         if not availableproducts:
             print(f"No available products for satellite {sat_id}.")
             continue
-
+        
+        options.extend(availableproducts)
+    
+    options.sort(key=lambda p: rank[p['entityId']])
+
+    # Budgets and disk-space planning: limit the queue, in priority order
+    skipped = set()
+    if max_gb is not None or max_products is not None:
+        keep = apply_budget([p['filesize'] for p in options], max_gb, max_products)
+        skipped.update(p['entityId'] for p, k in zip(options, keep) if not k)
+        options = [p for p, k in zip(options, keep) if k]
+    if reserve_gb is not None and options:
+        keep = plan_downloads([p['filesize'] for p in options], outdir, reserve_gb * 1024**3)
+        skipped.update(p['entityId'] for p, k in zip(options, keep) if not k)
+        options = [p for p, k in zip(options, keep) if k]
+
+    # Downloads run in a bounded pool while the retrieve loop keeps polling.
+    # The number of concurrent transfers is fixed (max_workers) or adapted 
+    # to the measured throughput
+    if concurrency:
+        tuner = ConcurrencyTuner(concurrency.get('min', 1), concurrency.get('max', 8),
+                                 concurrency.get('start'), label='Landsat downloads')
+    else:
+        tuner = ConcurrencyTuner(max_workers, max_workers)
+    pool = ThreadPoolExecutor(max_workers=tuner.max_workers)
+    writer = DiskWriter(disk_writer.get('threads', 2), disk_writer.get('buffer_mb', 256)) \
+        if disk_writer else None
+    futures = {}
+    
+    def run_download(download):
+        with tuner:
+            if deadline_passed(deadline):
+                raise DownloadPostponed("deadline reached, download postponed")
+            return download_scene(download, scene_index, outdir, band_patterns,
+                                  keep_tar, on_read=tuner.record, segments=segments,
+                                  writer=writer)
+    
+    def submit(downloads):
+        # highest priority first
+        for download in sorted(downloads, key=lambda d: rank.get(d['entityId'], len(rank))):
+            future = pool.submit(run_download, download)
+            futures[future] = download['entityId']
+
+    # Request the downloads of each satellite group
+    preparing = {}
+    for sat_id in dict.fromkeys(p['satellite'] for p in options):
+        availableproducts = [{'entityId': p['entityId'], 'productId': p['productId']}
+                             for p in options if p['satellite'] == sat_id]
+        
         requestedDownloadsCount = len(availableproducts)
         label = f"download-{sat_id}"
 
@@ -410,45 +750,109 @@ def download_landsat(results, outdir, username, token,
                                      download_req_payload, apiKey)
 
         if requestResults['preparingDownloads']:
-            downloadIds = []
-            download_retrieve_payload = {'label': label}
-
-            print("\nRequesting additional download URLs...")
-            while len(downloadIds) < (requestedDownloadsCount - len(requestResults['failed'])):
-                moreDownloadUrls = sendRequest(serviceUrl + "download-retrieve",
-                                               download_retrieve_payload, apiKey)
-
-                for download in moreDownloadUrls['available']:
-                    if (str(download['downloadId']) in requestResults['newRecords'] or
-                            str(download['downloadId']) in requestResults['duplicateProducts']):
-                        download_scene(download, group_df, outdir)
-                        downloadIds.append(download['downloadId'])
-
-                remaining = requestedDownloadsCount - len(downloadIds) - len(requestResults['failed'])
-                if remaining > 0:
-                    print(f"  {remaining} downloads still preparing. Waiting 30s...")
-                    time.sleep(30)
-
+            preparing[label] = (requestResults, requestedDownloadsCount, set())
         else:
-            print("\nAll downloads available immediately:\n")
-            for download in requestResults['availableDownloads']:
-                print(download)
-                download_scene(download, group_df, outdir)
+            print(f"\nAll {sat_id} downloads available immediately:\n")
+            submit(requestResults['availableDownloads'])
+
+    # Poll the prepared URLs of all groups and hand them to the pool
+    if preparing:
+        print("\nRequesting additional download URLs...")
+    while preparing:
+        if deadline_passed(deadline):
+            print("Deadline reached: no more downloads are requested")
+            # scenes still preparing are postponed
+            waiting = {label[len('download-'):] for label in preparing}
+            submitted = set(futures.values())
+            skipped.update(p['entityId'] for p in options
+                           if p['satellite'] in waiting and p['entityId'] not in submitted)
+            break
+        
+        ready = []
+        for label, (requestResults, requestedDownloadsCount, downloadIds) in list(preparing.items()):
+            moreDownloadUrls = sendRequest(serviceUrl + "download-retrieve",
+                                           {'label': label}, apiKey)
+
+            for download in moreDownloadUrls['available']:
+                if download['downloadId'] in downloadIds:
+                    continue
+                if (str(download['downloadId']) in requestResults['newRecords'] or
+                        str(download['downloadId']) in requestResults['duplicateProducts']):
+                    ready.append(download)
+                    downloadIds.add(download['downloadId'])
+
+            remaining = requestedDownloadsCount - len(downloadIds) - len(requestResults['failed'])
+            if remaining <= 0:
+                del preparing[label]
+            
+        submit(ready)
+        
+        remaining = sum(count - len(ids) - len(rr['failed'])
+                        for rr, count, ids in preparing.values())
+        if remaining > 0:
+            print(f"  {remaining} downloads still preparing. Waiting 30s...")
+            time.sleep(30)
+
+    # Wait for the pending transfers
+    downloaded = set()
+    for future in as_completed(futures):
+        if deadline_passed(deadline):
+            # scenes not started yet are postponed
+            for f in futures:
+                f.cancel()
+        if future.cancelled():
+            skipped.add(futures[future])
+            continue
+        try:
+            future.result()
+            downloaded.add(futures[future])
+        except DownloadPostponed:
+            skipped.add(futures[future])
+            continue
+        except Exception as e:
+            print(f"FAILED TO DOWNLOAD: {e}")
+            continue
+        
+        sensor, tile, displayId = scene_index[futures[future]]
+        tar_path = os.path.join(outdir, 'Landsat', sensor, tile, displayId + '.tar')
+        if store_dir and (not band_patterns or keep_tar):
+            store_add(store_dir, 'landsat', displayId, tar_path)
+        
+        # hand the tar over to the extraction stage
+        if extractor is not None and not band_patterns:
+            extractor.submit(tar_path)
+    pool.shutdown()
+    if writer is not None:
+        writer.close()
+    
+    failed = filtered.loc[~filtered['entityId'].isin(downloaded), 'displayId'].tolist()
+    if postponed is not None:
+        postponed.extend(filtered.loc[filtered['entityId'].isin(skipped), 'displayId'])
+    
+    return failed
                   
          
                 
-def download_scene(download, group_df, outdir):
+def download_scene(download, scene_index, outdir, band_patterns=None,
+                   keep_tar=False, on_read=None, segments=1, writer=None):
     """
     Download a single scene and save to Landsat/SENSOR/TILE/SCENE.tar
+    
+    scene_index maps each entityId to its (sensor, pathrow, displayId).
+    With band_patterns, only the matching tar members are written to
+    Landsat/SENSOR/TILE/ while the archive is streamed (the full tar is 
+    saved as well if keep_tar is True). on_read, if given, is called with
+    the number of bytes of every chunk received (e.g. ConcurrencyTuner.record).
+    Without band_patterns, the tar is fetched over up to segments parallel
+    connections (see transfer.fetch_to_file), and written through writer
+    (a transfer.DiskWriter) if given.
     """
     url = download['url']
     entityId = download['entityId']
 
-    # Find displayId to get SENSOR and TILE
-    row = group_df[group_df['entityId'] == entityId].iloc[0]
-    sensor = row['satellite']
-    tile = row['pathrow']
-    scene = row['displayId'] + '.tar'
+    # Look up SENSOR, TILE and displayId
+    sensor, tile, displayId = scene_index[entityId]
+    scene = displayId + '.tar'
 
     # Build target folder and ensure it exists
     dest_dir = os.path.join(outdir, 'Landsat', sensor, tile)
@@ -459,18 +863,133 @@ def download_scene(download, group_df, outdir):
     print(f"DOWNLOADING: {scene} -> {dest_dir}")
 
     downloadResponse = requests.get(url, stream=True)
+    downloadResponse.raise_for_status()
     if 'Content-Disposition' in downloadResponse.headers:
         content_disposition = cgi.parse_header(downloadResponse.headers['Content-Disposition'])[1]
         filename = os.path.basename(content_disposition['filename'])
     else:
         filename = scene
 
-    with open(filepath, 'wb') as f:
-        for chunk in downloadResponse.iter_content(chunk_size=8192):
-            if chunk:
-                f.write(chunk)
+    if band_patterns:
+        downloadResponse.raw.decode_content = True
+        members = extract_tar_stream(downloadResponse.raw, dest_dir, displayId,
+                                     band_patterns,
+                                     tar_path=filepath if keep_tar else None,
+                                     on_read=on_read)
+        downloadResponse.close()
+        print(f"Extracted {len(members)} members of {scene} to {dest_dir}\n")
+        return dest_dir
+
+    # large tars are fetched over several connections (byte ranges)
+    def open_range(start, end):
+        return requests.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+    
+    fetch_to_file(downloadResponse, open_range, filepath, segments, on_read, writer)
 
     print(f"Saved: {filepath}\n")
+    
+    return filepath
+
+
+
+class _TeeReader:
+    """
+    File-like wrapper that copies every byte read from a stream to a sink file
+    (and reports the number of bytes read to on_read).
+    """
+    def __init__(self, stream, sink, on_read=None):
+        self.stream = stream
+        self.sink = sink
+        self.on_read = on_read
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data and self.sink is not None:
+            self.sink.write(data)
+        if data and self.on_read is not None:
+            self.on_read(len(data))
+        return data
+
+
+
+def extract_tar_stream(stream, dest_dir, displayId, band_patterns, tar_path=None,
+                       on_read=None):
+    """
+    Extract the members of a tar archive matching band_patterns while it is
+    read from a (non seekable) stream.
+    
+    Members are first written to a hidden dest_dir/.displayId.partial folder
+    and moved to dest_dir only when the whole archive has been read, so that
+    an interrupted transfer never leaves an incomplete scene in place (the
+    partial folder and the partial tar are removed on any error). The
+    extracted band_patterns are then recorded in the scene marker (see 
+    inventory.mark_extracted).
+    
+    Parameters
+    ----------
+    stream : file-like
+        stream with the tar archive (e.g. the raw HTTP response)
+    dest_dir : str
+        folder where the selected members are saved
+    displayId : str
+        Landsat scene identifier
+    band_patterns : list
+        glob patterns (str) matched against the member file names
+    tar_path : str, optional
+        if given, the full archive is also saved at this path
+    on_read : callable, optional
+        called with the number of bytes of every read from the stream
+    
+    Returns
+    -------
+    members : list
+        paths of the extracted members
+    """
+    partial_dir = os.path.join(dest_dir, '.' + displayId + '.partial')
+    os.makedirs(partial_dir, exist_ok=True)
+    
+    sink = open(tar_path + '.part', 'wb') if tar_path else None
+    try:
+        reader = _TeeReader(stream, sink, on_read)
+        extracted = []
+        with tarfile.open(fileobj=reader, mode='r|') as tar:
+            for member in tar:
+                name = os.path.basename(member.name)
+                if not member.isfile() or not any(fnmatch(name, p) for p in band_patterns):
+                    continue
+                src = tar.extractfile(member)
+                with open(os.path.join(partial_dir, name), 'wb') as f:
+                    preallocate(f, member.size)
+                    shutil.copyfileobj(src, f, 1024 * 1024)
+                extracted.append(name)
+            
+        # read the end-of-archive blocks so that the saved tar is complete
+        if sink is not None:
+            while reader.read(1024 * 1024):
+                pass
+    except BaseException:
+        # interrupted transfer, full disk or corrupt tar: nothing is left
+        if sink is not None:
+            sink.close()
+            os.remove(tar_path + '.part')
+        shutil.rmtree(partial_dir, ignore_errors=True)
+        raise
+    finally:
+        if sink is not None:
+            sink.close()
+
+    members = []
+    for name in extracted:
+        target = os.path.join(dest_dir, name)
+        os.replace(os.path.join(partial_dir, name), target)
+        members.append(target)
+    shutil.rmtree(partial_dir, ignore_errors=True)
+    mark_extracted(dest_dir, displayId, band_patterns)
+    
+    if tar_path:
+        os.replace(tar_path + '.part', tar_path)
+
+    return members
 
 
 
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 09:37:52 2026
+
+@author: vpremier
+
+Asset-level Landsat download through the USGS Collection 2 STAC API: the
+scenes of query_landsat are resolved to their STAC items and only the band
+files matching band_patterns are downloaded, directly and concurrently.
+There is no M2M order to prepare (download-request / download-retrieve).
+
+The files are saved in the same layout as download_landsat with
+band_patterns: outdir/Landsat/SENSOR/PATHROW/SCENE_B3.TIF.
+"""
+
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
+
+import pandas as pd
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from download_queue import DownloadPostponed, apply_budget, deadline_passed, prioritize
+from inventory import Inventory, mark_extracted
+from transfer import ConcurrencyTuner, plan_downloads, preallocate
+
+
+STAC_URL = "https://landsatlook.usgs.gov/stac-server"
+STAC_COLLECTION = "landsat-c2l1"
+
+
+def stac_session():
+    """
+    HTTP session with retries on throttling and server errors.
+    """
+    session = requests.Session()
+    retries = Retry(total=5, backoff_factor=2, status_forcelist=[429, 500, 502, 503, 504],
+                    allowed_methods=["GET", "POST"])
+    session.mount("https://", HTTPAdapter(max_retries=retries, pool_maxsize=32))
+    session.mount("http://", HTTPAdapter(max_retries=retries, pool_maxsize=32))
+    return session
+
+
+
+def search_items(session, stac_url, ids, collection=STAC_COLLECTION, batch_size=100):
+    """
+    Resolve scene identifiers (displayId) to their STAC items with the
+    /search endpoint, batch_size ids per request. The 'next' links of the
+    pages are followed as in the STAC API paging spec: with their method
+    (GET by default) and, for POST, their body, merged into the previous
+    body if 'merge' is true.
+
+    Returns
+    -------
+    items : dict
+        displayId -> STAC item (dict). Scenes without an item are missing
+    """
+    items = {}
+    for i in range(0, len(ids), batch_size):
+        body = {'collections': [collection], 'ids': list(ids[i:i + batch_size]),
+                'limit': batch_size}
+        url, method = stac_url.rstrip('/') + '/search', 'POST'
+        while url:
+            if method == 'POST':
+                response = session.post(url, json=body, timeout=60)
+            else:
+                # the href of a GET link carries the whole query
+                response = session.get(url, timeout=60)
+            response.raise_for_status()
+            page = response.json()
+            for item in page.get('features', []):
+                items[item['id']] = item
+            link = next((l for l in page.get('links', []) if l.get('rel') == 'next'), None)
+            if link is None:
+                break
+            url, method = link['href'], link.get('method', 'GET').upper()
+            if method == 'POST' and 'body' in link:
+                body = {**body, **link['body']} if link.get('merge') else link['body']
+    return items
+
+
+
+def select_assets(item, band_patterns):
+    """
+    Assets of a STAC item whose file name matches one of band_patterns.
+
+    Returns
+    -------
+    assets : list
+        (file name, href, size in bytes or 0) of every selected asset
+    """
+    assets = []
+    for asset in item.get('assets', {}).values():
+        href = asset.get('href', '')
+        name = os.path.basename(href.split('?')[0])
+        if any(fnmatch(name, p) for p in band_patterns):
+            assets.append((name, href, asset.get('file:size', 0)))
+    return assets
+
+
+
+def download_asset(session, href, filepath, size=0, on_read=None):
+    """
+    Stream one asset to filepath. on_read, if given, is called with the
+    number of bytes of every chunk received.
+    """
+    with session.get(href, stream=True, timeout=300) as response:
+        response.raise_for_status()
+        with open(filepath, 'wb') as f:
+            preallocate(f, int(response.headers.get('Content-Length', size)))
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                if chunk:
+                    f.write(chunk)
+                    if on_read:
+                        on_read(len(chunk))
+            f.truncate()
+    return filepath
+
+
+
+def download_landsat_stac(results, outdir, band_patterns, stac_url=STAC_URL,
+                          collection=STAC_COLLECTION, pathrowList=None,
+                          tierList=None, max_workers=4, reserve_gb=None,
+                          priority='catalogue', preferred_missions=None,
+                          max_gb=None, max_products=None, deadline=None,
+                          concurrency=None, inventory=None, postponed=None):
+    """
+    Download the selected band files of a list of Landsat scenes from the
+    STAC API. The band files of every scene are downloaded concurrently
+    into a hidden .SCENE.partial folder and moved to
+    outdir/Landsat/SENSOR/PATHROW/ when all of them are complete.
+
+    Parameters
+    ----------
+    results : pd.DataFrame
+        scenes to download, as returned by query_landsat (displayId)
+    outdir : str
+        output directory
+    band_patterns : list
+        glob patterns (str) of the files to download, e.g.
+        ['*_B3.TIF', '*_B6.TIF', '*_MTL.txt']. If empty, all the assets of
+        the items are downloaded
+    stac_url : str, optional
+        root of the STAC API. Default is the USGS LandsatLook STAC server
+    collection : str, optional
+        STAC collection. Default is 'landsat-c2l1'
+    pathrowList, tierList : list, optional
+        path/rows and tiers to download
+    max_workers : int, optional
+        number of files downloaded in parallel. Default is 4
+    reserve_gb, priority, preferred_missions, max_gb, max_products,
+    deadline, concurrency : optional
+        see download_landsat. Sizes are taken from the 'file:size' of the
+        assets (when given by the server)
+    inventory : inventory.Inventory, optional
+        listing of outdir used to skip the scenes already downloaded
+    postponed : list, optional
+        if given, the displayIds of the scenes postponed (budgets, disk
+        reserve, deadline) are appended to it. They are also returned as
+        failed
+
+    Returns
+    -------
+    failed : list
+        displayIds of the scenes that could not be downloaded
+    """
+    if results.empty:
+        print("No Landsat scenes to download.")
+        return []
+    band_patterns = band_patterns or ['*']
+
+    scenes = pd.DataFrame({
+        'displayId': results['displayId'],
+        'satellite': results['displayId'].str.split('_').str[0],
+        'pathrow': results['displayId'].str.split('_').str[2],
+        'tier': results['displayId'].str.split('_').str[-1],
+        'cloud': results['cloudCover'] if 'cloudCover' in results else float('nan'),
+    })
+    if pathrowList:
+        scenes = scenes[scenes['pathrow'].isin(pathrowList)]
+    if tierList:
+        scenes = scenes[scenes['tier'].isin(tierList)]
+
+    # Skip the scenes already in place (one scan of the output tree)
+    if inventory is None:
+        inventory = Inventory(outdir)
+    done = inventory.has_members(scenes['displayId'], band_patterns)
+    dest_dirs = [os.path.join(outdir, 'Landsat', s, p)
+                 for s, p in zip(scenes['satellite'], scenes['pathrow'])]
+    scenes = scenes.assign(dest_dir=dest_dirs)[~done]
+    print(f"Already downloaded: {done.sum()} scenes")
+
+    # Priority order of the queue
+    queue = pd.DataFrame({
+        'date': scenes['displayId'].str.split('_').str[3],
+        'cloud': scenes['cloud'],
+        'tile': scenes['pathrow'],
+        'mission': scenes['satellite'],
+    })
+    scenes = scenes.iloc[prioritize(queue, priority, preferred_missions)]
+    queued = scenes['displayId'].tolist()
+
+    # Resolve the scenes to their STAC items and assets
+    session = stac_session()
+    items = search_items(session, stac_url, scenes['displayId'].tolist(), collection)
+    assets = {}
+    for displayId in scenes['displayId']:
+        if displayId not in items:
+            print(f"No STAC item for {displayId}")
+            continue
+        selected = select_assets(items[displayId], band_patterns)
+        if not selected:
+            print(f"No asset of {displayId} matches {band_patterns}")
+            continue
+        assets[displayId] = selected
+    scenes = scenes[scenes['displayId'].isin(assets)]
+
+    # Budgets and disk-space planning: limit the queue, in priority order
+    sizes = [sum(a[2] for a in assets[d]) for d in scenes['displayId']]
+    skipped = set()
+    if max_gb is not None or max_products is not None:
+        keep = apply_budget(sizes, max_gb, max_products)
+        skipped.update(scenes.loc[[not k for k in keep], 'displayId'])
+        scenes, sizes = scenes[keep], [s for s, k in zip(sizes, keep) if k]
+    if reserve_gb is not None and not scenes.empty:
+        keep = plan_downloads(sizes, outdir, reserve_gb * 1024**3)
+        skipped.update(scenes.loc[[not k for k in keep], 'displayId'])
+        scenes = scenes[keep]
+
+    print(f"To download: {len(scenes)} scenes "
+          f"({sum(len(assets[d]) for d in scenes['displayId'])} files)")
+
+    if concurrency:
+        tuner = ConcurrencyTuner(concurrency.get('min', 1), concurrency.get('max', 8),
+                                 concurrency.get('start'), label='Landsat STAC downloads')
+    else:
+        tuner = ConcurrencyTuner(max_workers, max_workers)
+
+    def run_download(href, filepath, size):
+        with tuner:
+            if deadline_passed(deadline):
+                raise DownloadPostponed("deadline reached, download postponed")
+            return download_asset(session, href, filepath, size, on_read=tuner.record)
+
+    # One task per file; a scene is moved in place when its last file is done
+    futures = {}
+    remaining = {}
+    with ThreadPoolExecutor(max_workers=tuner.max_workers) as pool:
+        for row in scenes.itertuples(index=False):
+            partial_dir = os.path.join(row.dest_dir, '.' + row.displayId + '.partial')
+            os.makedirs(partial_dir, exist_ok=True)
+            remaining[row.displayId] = len(assets[row.displayId])
+            for name, href, size in assets[row.displayId]:
+                future = pool.submit(run_download, href, os.path.join(partial_dir, name), size)
+                futures[future] = row.displayId
+
+        downloaded, failed = set(), set()
+        for future in as_completed(futures):
+            displayId = futures[future]
+            try:
+                future.result()
+            except DownloadPostponed:
+                skipped.add(displayId)
+                failed.add(displayId)
+            except Exception as e:
+                if displayId not in failed:
+                    print(f"FAILED TO DOWNLOAD {displayId}: {e}")
+                failed.add(displayId)
+            remaining[displayId] -= 1
+            if remaining[displayId] or displayId in failed:
+                continue
+
+            dest_dir = scenes.loc[scenes['displayId'] == displayId, 'dest_dir'].iloc[0]
+            partial_dir = os.path.join(dest_dir, '.' + displayId + '.partial')
+            for name in os.listdir(partial_dir):
+                os.replace(os.path.join(partial_dir, name), os.path.join(dest_dir, name))
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            mark_extracted(dest_dir, displayId, band_patterns)
+            downloaded.add(displayId)
+            print(f"Saved {len(assets[displayId])} files of {displayId} to {dest_dir}")
+
+    if postponed is not None:
+        postponed.extend(d for d in queued if d in skipped and d not in downloaded)
+    return [d for d in queued if d not in downloaded]
@@ -7,78 +7,402 @@ Created on Wed Jul  9 09:57:13 2025
 """
 
 import os
+import json
 import time
 from dotenv import load_dotenv
 load_dotenv()
 
 from landsat_query_download import *
 from sentinel2_query_download import *
+from aoi_batch import *
+from catalog import query_catalog_cdse, query_catalog_landsat
+from archive_audit import audit_archives
+from extraction import Extractor
+from inventory import Inventory
+from landsat_stac import STAC_URL, download_landsat_stac
+from tile_index import aoi_pathrows, aoi_tiles
+from work_queue import is_published, publish_queue, queue_path, run_worker
 from utils import *
 
-def run_query_download(config_path):
+
+# fields of the query results shared through the cooperative work queue
+S2_QUEUE_COLUMNS = ['Id', 'Name', 'ContentLength', 'Checksum', 'cloudCover']
+LANDSAT_QUEUE_COLUMNS = ['displayId', 'entityId', 'cloudCover']
+
+
+def queue_items(products, columns):
+    """
+    JSON-serializable records with the given columns of a query result.
+    """
+    cols = [c for c in columns if c in products]
+    return json.loads(products[cols].to_json(orient='records'))
+
+
+def resolve_tile_lists(config, aoi, s2_tile_list, landsat_tile_list):
+    """
+    Fill the empty tile lists with the Sentinel-2 tiles and Landsat 
+    path/rows that intersect the AOI (offline tile index), if 
+    'resolve_tiles' is set.
+    """
+    if not config.get("resolve_tiles", False):
+        return s2_tile_list, landsat_tile_list
     
-    config = load_config(config_path)
-    check_config_consistency(config)
+    min_overlap = config.get("tile_min_overlap", 0.0)
+    if not s2_tile_list:
+        s2_tile_list = aoi_tiles(aoi, min_overlap, config.get("mgrs_grid_file"))
+        print(f"AOI tiles: {', '.join(s2_tile_list)}")
+    if not landsat_tile_list:
+        landsat_tile_list = aoi_pathrows(aoi, min_overlap, config.get("wrs2_grid_file"))
+        print(f"AOI path/rows: {', '.join(landsat_tile_list)}")
+    return s2_tile_list, landsat_tile_list
+
+
+def query_landsat_scenes(opts, shp, ingested_after=None):
+    """
+    Landsat query of a run: from the local catalog (offline_query) or from
+    M2M (only scenes ingested after ingested_after, if given).
+    """
+    if opts.offline:
+        return query_catalog_landsat(opts.catalog, opts.date_start, opts.date_end, 
+                                     shp = shp, 
+                                     max_cc = opts.max_cc,
+                                     sat = opts.landsat_satellite,
+                                     min_cover = opts.min_cover,
+                                     pathrowList = opts.landsat_tile_list,
+                                     tierList = ['T1'])
+    
+    return query_landsat(opts.date_start, 
+                         opts.date_end, 
+                         os.getenv("ERS_USERNAME"), 
+                         os.getenv("ERS_TOKEN"), 
+                         shp = shp, 
+                         max_cc = opts.max_cc,
+                         sat = opts.landsat_satellite,
+                         ingested_after = ingested_after,
+                         min_cover = opts.min_cover,
+                         catalog = opts.catalog,
+                         pathrowList = opts.landsat_tile_list,
+                         tierList = ['T1'])
+
+
+def query_s2_products(opts, shp, published_after=None):
+    """
+    Sentinel-2 query of a run: from the local catalog (offline_query) or 
+    from CDSE (only products published after published_after, if given).
+    """
+    if opts.offline:
+        return query_catalog_cdse(opts.catalog, opts.date_start, opts.date_end, 
+                                  shp = shp,
+                                  max_cc = opts.max_cc, 
+                                  tile = opts.s2_tile_list, 
+                                  filter_date = True,
+                                  min_cover = opts.min_cover,
+                                  RON_list = opts.s2_orbit_list,
+                                  min_baseline = opts.s2_min_baseline)
+    
+    return query_cdse(opts.date_start, 
+                      opts.date_end, 
+                      os.getenv("CDSE_USERNAME"), 
+                      os.getenv("CDSE_PASSWORD"), 
+                      shp = shp,
+                      max_cc = opts.max_cc, 
+                      tile = opts.s2_tile_list, 
+                      filter_date = True,
+                      published_after = published_after,
+                      min_cover = opts.min_cover,
+                      catalog = opts.catalog,
+                      RON_list = opts.s2_orbit_list,
+                      min_baseline = opts.s2_min_baseline)
+
+
+def download_landsat_scenes(opts, results, extractor=None, inventory=None, postponed=None):
+    """
+    Download Landsat scenes with the backend and the options of a run.
+    Returns the displayIds of the scenes that could not be downloaded.
+    """
+    if opts.landsat_backend == "stac":
+        # band files straight from the STAC assets, no M2M order
+        return download_landsat_stac(results, opts.outdir, opts.landsat_bands,
+                                     stac_url = opts.landsat_stac_url or STAC_URL,
+                                     pathrowList = opts.landsat_tile_list, 
+                                     tierList = ['T1'],
+                                     max_workers = opts.landsat_workers,
+                                     reserve_gb = opts.reserve_gb,
+                                     priority = opts.priority,
+                                     preferred_missions = opts.preferred_missions,
+                                     max_gb = opts.max_gb,
+                                     max_products = opts.max_products,
+                                     deadline = opts.deadline,
+                                     concurrency = opts.concurrency,
+                                     inventory = inventory,
+                                     postponed = postponed)
+    
+    return download_landsat(results, opts.outdir, os.getenv("ERS_USERNAME"), 
+                            os.getenv("ERS_TOKEN"), 
+                            pathrowList = opts.landsat_tile_list, 
+                            tierList = ['T1'],
+                            max_workers = opts.landsat_workers,
+                            band_patterns = opts.landsat_bands,
+                            keep_tar = opts.landsat_keep_tar,
+                            store_dir = opts.store_dir,
+                            reserve_gb = opts.reserve_gb,
+                            priority = opts.priority,
+                            preferred_missions = opts.preferred_missions,
+                            max_gb = opts.max_gb,
+                            max_products = opts.max_products,
+                            deadline = opts.deadline,
+                            concurrency = opts.concurrency,
+                            extractor = extractor,
+                            segments = opts.segments,
+                            disk_writer = opts.disk_writer,
+                            inventory = inventory,
+                            postponed = postponed)
+
+
+def download_s2_products(opts, s2List, extractor=None, inventory=None, postponed=None):
+    """
+    Download Sentinel-2 products with the options of a run. Returns the
+    names of the products that could not be downloaded.
+    """
+    return download_cdse(s2List, opts.outdir, os.getenv("CDSE_USERNAME"), 
+                         os.getenv("CDSE_PASSWORD"),
+                         band_patterns = opts.s2_bands,
+                         store_dir = opts.store_dir,
+                         reserve_gb = opts.reserve_gb,
+                         priority = opts.priority,
+                         preferred_missions = opts.preferred_missions,
+                         max_gb = opts.max_gb,
+                         max_products = opts.max_products,
+                         deadline = opts.deadline,
+                         concurrency = opts.concurrency,
+                         extractor = extractor,
+                         segments = opts.segments,
+                         disk_writer = opts.disk_writer,
+                         inventory = inventory,
+                         postponed = postponed)
 
-    # flags
-    landsat_query = config["query_landsat"]
-    sentinel2_query = config["query_sentinel2"]
+
+def start_downloads(opts):
+    """
+    Integrity audit of the archives already on disk (bad ones are reported, 
+    or requeued so that they are downloaded again) and extraction stage 
+    (archives are extracted on a process pool while the next products 
+    download). Returns the extractor, or None.
+    """
+    if opts.audit:
+        audit_archives(opts.outdir, action = opts.audit)
     
-    landsat_download = config["download_landsat"]
-    sentinel2_download = config["download_sentinel2"]
+    if opts.extract is None:
+        return None
+    return Extractor(workers = opts.extract.get("workers"),
+                     delete_archives = opts.extract.get("delete_archives", False))
+
+
+def output_inventory(opts):
+    """
+    One listing of the output tree for the skip checks of all downloads.
+    """
+    return Inventory(opts.outdir, os.path.join(opts.outdir, '.inventory.json') 
+                     if opts.inventory_cache else None)
+
+
+def run_query_download(config_path):
     
+    config = load_config(config_path)
+    check_config_consistency(config)
     
-    outdir = config["output_directory"]
+    # batch job: many AOIs sharing one query and one download queue
+    if config.get("aois"):
+        run_batch_query_download(config)
+        return
     
-    date_start = config["date_start"]
-    date_end = config["date_end"]
+    opts = read_options(config)
+    shp = opts.shapefile
+    opts.s2_tile_list, opts.landsat_tile_list = resolve_tile_lists(
+        config, shp, opts.s2_tile_list, opts.landsat_tile_list)
     
-    shp = config["shapefile"]
+    landsat_query = opts.landsat_query
+    sentinel2_query = opts.sentinel2_query
     
-    max_cc = config["max_cloudcover"]
+    # parameters that define the query of each collection
+    query_params = {'date_start': opts.date_start, 'date_end': opts.date_end, 
+                    'shapefile': os.path.abspath(shp), 'max_cloudcover': opts.max_cc,
+                    'min_cover': opts.min_cover, 'offline': opts.offline}
+    landsat_params = dict(query_params, collection = 'LANDSAT_C2_L1',
+                          satellite = opts.landsat_satellite,
+                          tiles = opts.landsat_tile_list, tiers = ['T1'])
+    s2_params = dict(query_params, collection = 'S2MSI1C', tiles = opts.s2_tile_list,
+                     orbits = opts.s2_orbit_list, min_baseline = opts.s2_min_baseline)
     
-    landsat_satellite = config["landsat_satellite"]
+    # delta sync: query only products newer than the last successful run.
+    # The watermark belongs to the query (date_end excepted, which moves 
+    # forward between scheduled runs)
+    sync = opts.sync
+    state_path = os.path.join(opts.outdir, '.sync_state.json')
+    state = load_sync_state(state_path) if sync else {}
+    landsat_key = sync_key(shp, 'LANDSAT_C2_L1', 
+                           {k: v for k, v in landsat_params.items() if k != 'date_end'})
+    s2_key = sync_key(shp, 'S2MSI1C', 
+                      {k: v for k, v in s2_params.items() if k != 'date_end'})
+    if sync and opts.offline:
+        print("Delta sync is not applied to offline queries.")
+        sync = False
+        state = {}
     
-
-    s2_tile_list = config["s2_tile_list"]
-    landsat_tile_list = config["landsat_tile_list"]
+    # cooperative mode: the query result is published as a work queue on the
+    # shared filesystem and every process (on any host) downloads from it
+    queue_config = config.get("work_queue")
+    if queue_config:
+        # one queue per query: the folder name and the manifest identify 
+        # the query parameters
+        landsat_queue = queue_path(queue_config["directory"], 'landsat', landsat_params)
+        s2_queue = queue_path(queue_config["directory"], 'sentinel2', s2_params)
+        lease_seconds = queue_config.get("lease_minutes", 15) * 60
+        batch_size = queue_config.get("batch_size", 4)
+        if sync:
+            print("Delta sync is not applied in cooperative mode.")
+            sync = False
+            state = {}
+        
+        # products already published by another process: no query needed
+        landsat_query = landsat_query and not is_published(landsat_queue, landsat_params)
+        sentinel2_query = sentinel2_query and not is_published(s2_queue, s2_params)
     
     
     if landsat_query:
-
-        results = query_landsat(date_start, 
-                                date_end, 
-                                os.getenv("ERS_USERNAME"), 
-                                os.getenv("ERS_TOKEN"), 
-                                shp = shp, 
-                                max_cc=max_cc,
-                                sat = landsat_satellite)
+        
+        results = query_landsat_scenes(opts, shp, ingested_after = state.get(landsat_key))
+        
+        if queue_config and not opts.offline:
+            publish_queue(landsat_queue, queue_items(results, LANDSAT_QUEUE_COLUMNS), 'displayId',
+                          landsat_params)
         
     if sentinel2_query:
-
-        s2List = query_cdse(date_start, 
-                            date_end, 
-                            os.getenv("CDSE_USERNAME"), 
-                            os.getenv("CDSE_PASSWORD"), 
-                            shp=shp,
-                            max_cc = max_cc, 
-                            tile=s2_tile_list, 
-                            filter_date = True) 
-    
-    if landsat_download:
-                
-        download_landsat(results, outdir, os.getenv("ERS_USERNAME"), 
-                            os.getenv("ERS_TOKEN"), 
-                            pathrowList = landsat_tile_list, 
-                            tierList = ['T1'])
+        
+        s2List = query_s2_products(opts, shp, published_after = state.get(s2_key))
+        
+        if queue_config and not opts.offline:
+            publish_queue(s2_queue, queue_items(s2List, S2_QUEUE_COLUMNS), 'Name', s2_params)
+    
+    if not (opts.landsat_download or opts.sentinel2_download):
+        return
+    
+    extractor = start_downloads(opts)
+    try:
+        inventory = output_inventory(opts)
+        
+        if opts.landsat_download:
+        
+            if queue_config:
+                def landsat_handler(items):
+                    postponed = []
+                    failed = download_landsat_scenes(opts, pd.DataFrame(items), extractor,
+                                                     inventory, postponed)
+                    return failed, postponed
+            
+                run_worker(landsat_queue, landsat_handler,
+                           batch_size = batch_size, lease_seconds = lease_seconds)
+            else:
+                failed = download_landsat_scenes(opts, results, extractor, inventory)
+        
+            # advance the watermark only if every scene was downloaded
+            if sync and not failed:
+                state[landsat_key] = results.attrs['watermark']
+                save_sync_state(state_path, state)
     
-    if sentinel2_download:
+        if opts.sentinel2_download:
         
-        download_cdse(s2List, outdir, os.getenv("CDSE_USERNAME"), os.getenv("CDSE_PASSWORD"))
+            if queue_config:
+                def s2_handler(items):
+                    postponed = []
+                    failed = download_s2_products(opts, pd.DataFrame(items), extractor,
+                                                  inventory, postponed)
+                    return failed, postponed
+            
+                run_worker(s2_queue, s2_handler,
+                           batch_size = batch_size, lease_seconds = lease_seconds)
+            else:
+                failed = download_s2_products(opts, s2List, extractor, inventory)
         
+            # advance the watermark only if every product was downloaded
+            if sync and not failed and s2List.attrs.get('watermark'):
+                state[s2_key] = s2List.attrs['watermark']
+                save_sync_state(state_path, state)
+    finally:
+        if extractor is not None:
+            extractor.close()
         
+        
+
 
-    # check the config
+def run_batch_query_download(config):
+    """
+    Run a batch job over the AOIs listed in config["aois"]. The AOIs share a
+    single merged query per mission; each product is assigned to the AOIs 
+    its footprint intersects, downloaded once into config["output_directory"]
+    and then hard-linked into the output_directory of each of its AOIs.
+    """
+    
+    opts = read_options(config)
+    
+    if opts.sync:
+        print("Delta sync is not supported for batch jobs: querying the full period.")
+    
+    aois = config["aois"]
+    aoi_gdf = read_aois(aois)
+    opts.s2_tile_list, opts.landsat_tile_list = resolve_tile_lists(
+        config, aoi_gdf, opts.s2_tile_list, opts.landsat_tile_list)
+    
+    
+    if opts.landsat_query:
+        
+        results = query_landsat_scenes(opts, aoi_gdf)
+        results = assign_products(results, aoi_gdf, results.get('footprint', []))
+        
+    if opts.sentinel2_query:
+        
+        s2List = query_s2_products(opts, aoi_gdf)
+        s2List = assign_products(s2List, aoi_gdf, s2List.get('footprint', []))
+    
+    if not (opts.landsat_download or opts.sentinel2_download):
+        return
+    
+    extractor = start_downloads(opts)
+    try:
+        inventory = output_inventory(opts)
+        
+        if opts.landsat_download:
+            download_landsat_scenes(opts, results, extractor, inventory)
+    
+        if opts.sentinel2_download:
+            download_s2_products(opts, s2List, extractor, inventory)
+    finally:
+        # the extracted products must be in place before linking them
+        if extractor is not None:
+            extractor.close()
+    
+    if opts.landsat_download:
+        
+        for aoi in aois:
+            selected = results[results['aoi'].apply(lambda names: aoi['name'] in names)]
+            rel_dirs = [os.path.join('Landsat', d.split('_')[0], d.split('_')[2])
+                        for d in selected['displayId']]
+            n = materialize_products(opts.outdir, aoi['output_directory'], 
+                                     rel_dirs, selected['displayId'].tolist())
+            print(f"{aoi['name']}: linked {n}/{len(selected)} Landsat scenes")
+    
+    if opts.sentinel2_download:
+        
+        for aoi in aois:
+            selected = s2List[s2List['aoi'].apply(lambda names: aoi['name'] in names)]
+            rel_dirs = [os.path.join('Sentinel2', n.split('_')[5]) for n in selected['Name']]
+            prefixes = [n.replace('.SAFE', '') for n in selected['Name']]
+            n = materialize_products(opts.outdir, aoi['output_directory'], rel_dirs, prefixes)
+            print(f"{aoi['name']}: linked {n}/{len(selected)} Sentinel-2 products")
+    
+    
+    
+    
 
     
 
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 09:02:11 2026
+
+@author: vpremier
+"""
+
+import fcntl
+import hashlib
+import os
+import shutil
+
+
+# ioctl request to clone a file (reflink) on btrfs/XFS
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """
+    Materialize src at dst without copying data when possible: a hard link
+    first, then a reflink (copy-on-write clone), and a plain copy as the 
+    last resort (e.g. across filesystems without reflink support).
+
+    Returns
+    -------
+    method : str
+        'hardlink', 'reflink' or 'copy'
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + '.part'
+    try:
+        os.link(src, tmp)
+        method = 'hardlink'
+    except OSError:
+        try:
+            with open(src, 'rb') as fsrc, open(tmp, 'wb') as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            method = 'reflink'
+        except OSError:
+            shutil.copyfile(src, tmp)
+            method = 'copy'
+    os.replace(tmp, dst)
+    return method
+
+
+
+def get_md5(checksum):
+    """
+    Return the MD5 value from the CDSE 'Checksum' field (a list of dicts 
+    with 'Algorithm' and 'Value', or the MD5 string already extracted by
+    query_cdse), or None if it is not available.
+    """
+    if isinstance(checksum, str):
+        return checksum.lower() or None
+    if not isinstance(checksum, (list, tuple)):
+        return None
+    for c in checksum:
+        if isinstance(c, dict) and c.get('Algorithm') == 'MD5' and c.get('Value'):
+            return c['Value'].lower()
+    return None
+
+
+
+def file_md5(path, chunk_size=8 * 1024 * 1024):
+    """
+    Compute the MD5 hex digest of a file.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+
+def store_path(store_dir, kind, product_id, filename, checksum=None):
+    """
+    Path of a product in the global store:
+    store_dir/KIND/PRODUCT_ID/CHECKSUM/FILENAME
+    
+    Products without a known checksum are kept under 'nochecksum'.
+    """
+    key = checksum.lower() if checksum else 'nochecksum'
+    return os.path.join(store_dir, kind, product_id, key, filename)
+
+
+
+def store_lookup(store_dir, kind, product_id, filename, checksum=None):
+    """
+    Look up a product in the global store.
+
+    Parameters
+    ----------
+    store_dir : str
+        root of the global store
+    kind : str
+        'sentinel2' or 'landsat'
+    product_id : str
+        product identifier (S2 Name or Landsat displayId)
+    filename : str
+        archive file name
+    checksum : str, optional
+        expected MD5. If given, only a copy with the same checksum is returned
+
+    Returns
+    -------
+    path : str or None
+        path of the stored archive, None if it is not in the store
+    """
+    if checksum:
+        path = store_path(store_dir, kind, product_id, filename, checksum)
+        candidates = [path]
+    else:
+        product_dir = os.path.join(store_dir, kind, product_id)
+        if not os.path.isdir(product_dir):
+            return None
+        with os.scandir(product_dir) as entries:
+            candidates = [os.path.join(e.path, filename) for e in entries if e.is_dir()]
+
+    for path in candidates:
+        if os.path.isfile(path) and os.stat(path).st_size > 0:
+            return path
+    return None
+
+
+
+def store_add(store_dir, kind, product_id, path, checksum=None):
+    """
+    Add a downloaded archive to the global store (as a hard link when the 
+    store is on the same filesystem). If a checksum is given, the archive 
+    is verified first and is not stored when it does not match.
+
+    Returns
+    -------
+    stored : str or None
+        path of the archive in the store, None if verification failed
+    """
+    dst = store_path(store_dir, kind, product_id, os.path.basename(path), checksum)
+    if os.path.isfile(dst):
+        return dst
+
+    if checksum and file_md5(path) != checksum.lower():
+        print(f"Checksum mismatch for {os.path.basename(path)}: not added to the store")
+        return None
+
+    clone_file(path, dst)
+    return dst
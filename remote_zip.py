@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 10:12:40 2026
+
+@author: vpremier
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import zipfile
+from fnmatch import fnmatch
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpRangeFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an HTTP resource, backed by Range
+    requests. It can be passed to zipfile.ZipFile, so that only the central 
+    directory and the selected entries of a remote zip are transferred.
+    
+    Reads are served from a single read-ahead block of block_size bytes. 
+    The read-ahead never goes past readahead_end (when set), so that 
+    reading one entry does not transfer the following ones.
+    """
+
+    def __init__(self, url, session=None, block_size=4 * 1024 * 1024):
+        self.url = url
+        self.session = session if session is not None else requests.Session()
+        self.block_size = block_size
+        self.pos = 0
+        self.readahead_end = None
+        self.bytes_read = 0
+        self._buf_start = 0
+        self._buf = b''
+
+        # probe the size (and the Range support) with the first byte
+        response = self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+        response.raise_for_status()
+        content_range = response.headers.get('Content-Range')
+        response.close()
+        if response.status_code != 206 or not content_range:
+            raise IOError(f"Server does not support HTTP Range requests: {url}")
+        self.size = int(content_range.split('/')[-1])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self.pos
+
+    def _fetch(self, start, end):
+        # inclusive byte range [start, end]
+        response = self.session.get(self.url, headers={'Range': f'bytes={start}-{end}'})
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise IOError(f"Range request ignored by the server: {self.url}")
+        self.bytes_read += len(response.content)
+        return response.content
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = min(size, self.size - self.pos)
+        if size <= 0:
+            return b''
+
+        buf_end = self._buf_start + len(self._buf)
+        if not (self._buf_start <= self.pos and self.pos + size <= buf_end):
+            end = self.pos + max(size, self.block_size)
+            if self.readahead_end is not None:
+                end = min(end, max(self.readahead_end, self.pos + size))
+            end = min(end, self.size) - 1
+            self._buf = self._fetch(self.pos, end)
+            self._buf_start = self.pos
+
+        offset = self.pos - self._buf_start
+        data = self._buf[offset:offset + size]
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+
+def extract_remote_zip(url, dest_dir, patterns, session=None):
+    """
+    Extract the entries of a remote zip whose file name matches any of the 
+    glob patterns, using HTTP Range requests. The archive tree is kept, 
+    so that e.g. a Sentinel-2 SAFE zip results in a sparse SAFE folder.
+    
+    The entries are first written to a hidden dest_dir/.partial_* folder and
+    moved into dest_dir once all entries are done (entries already in 
+    dest_dir are kept or replaced).
+
+    Parameters
+    ----------
+    url : str
+        url of the zip archive
+    dest_dir : str
+        folder where the entries are extracted
+    patterns : list
+        glob patterns (str) matched against the entry file names, 
+        e.g. ['*_B03.jp2', '*_SCL_20m.jp2', 'MTD_*.xml']
+    session : requests.Session, optional
+        session used for the requests (e.g. with authorization headers)
+
+    Returns
+    -------
+    members : list
+        names of the extracted entries
+    nbytes : int
+        number of bytes transferred
+    """
+    if session is None:
+        session = requests.Session()
+        retries = Retry(total=5, backoff_factor=1,
+                        status_forcelist=[500, 502, 503, 504],
+                        allowed_methods=["GET"])
+        session.mount('https://', HTTPAdapter(max_retries=retries))
+
+    remote = HttpRangeFile(url, session)
+    os.makedirs(dest_dir, exist_ok=True)
+    partial_dir = tempfile.mkdtemp(prefix='.partial_', dir=dest_dir)
+    try:
+        members = []
+        with zipfile.ZipFile(remote) as zf:
+            # each entry ends where the next one (or the central directory) starts
+            offsets = sorted(info.header_offset for info in zf.infolist()) + [zf.start_dir]
+            next_offset = dict(zip(offsets[:-1], offsets[1:]))
+            
+            for info in zf.infolist():
+                name = info.filename
+                if info.is_dir() or not any(fnmatch(os.path.basename(name), p) for p in patterns):
+                    continue
+                # never write outside dest_dir
+                if os.path.isabs(name) or '..' in name.split('/'):
+                    continue
+                target = os.path.join(partial_dir, *name.split('/'))
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                remote.readahead_end = next_offset[info.header_offset]
+                with zf.open(info) as src, open(target, 'wb') as f:
+                    shutil.copyfileobj(src, f, 1024 * 1024)
+                members.append(name)
+
+        # merged into the existing tree: entries retrieved by earlier runs
+        # (e.g. with other patterns) are kept
+        for name in members:
+            target = os.path.join(dest_dir, *name.split('/'))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(os.path.join(partial_dir, *name.split('/')), target)
+    finally:
+        # also after a failed read: no partial folder is left behind
+        shutil.rmtree(partial_dir, ignore_errors=True)
+
+    return members, remote.bytes_read
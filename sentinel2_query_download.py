@@ -8,9 +8,12 @@ Created on Wed Jul  9 14:07:58 2025
 import subprocess
 import requests
 import os
+import threading
+import numpy as np
 import geopandas as gpd
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from shapely.geometry import box, shape
 
@@ -18,11 +21,60 @@ from shapely.geometry import box, shape
 import matplotlib.pyplot as plt
 
 from sentinel_filters import *
+from remote_zip import extract_remote_zip
+from product_store import clone_file, get_md5, store_add, store_lookup
+from transfer import (ConcurrencyTuner, DiskWriter, fetch_to_file, is_throttled,
+                      plan_downloads)
+from download_queue import apply_budget, deadline_passed, prioritize
+from catalog import update_catalog
+from inventory import Inventory, mark_extracted
+
+# OData fields of the products kept by query_cdse
+CATALOGUE_FIELDS = ['Id', 'Name', 'ContentLength', 'Checksum', 'PublicationDate',
+                    'ContentDate', 'Footprint']
+
+
+def baseline_number(baseline):
+    """
+    Processing baseline as a number (e.g. 'N0500' -> 5.0, 5.0 -> 5.0).
+    """
+    if isinstance(baseline, str):
+        return int(baseline.lstrip('N')) / 100
+    return float(baseline)
+
+
+def parse_products(values):
+    """
+    Compact table of the products of an OData response page: one row per
+    product with Id, Name, ContentLength (int), Checksum (MD5 string or None),
+    PublicationDate and date (sensing start) as datetime64, cloudCover and 
+    the footprint as a shapely geometry array (EPSG:4326). The nested JSON
+    objects are not kept.
+    """
+    footprints = pd.Series([v.get('Footprint') for v in values], dtype=object)
+    # e.g. "geography'SRID=4326;POLYGON ((...))'"
+    wkt = footprints.str.split(';', n=1).str[1].str.rstrip("'")
+    
+    return pd.DataFrame({
+        'Id': [v['Id'] for v in values],
+        'Name': [v['Name'] for v in values],
+        'ContentLength': np.array([v.get('ContentLength', 0) for v in values], dtype=np.int64),
+        'Checksum': [get_md5(v.get('Checksum')) for v in values],
+        'PublicationDate': pd.to_datetime([v.get('PublicationDate') for v in values], utc=True),
+        'date': pd.to_datetime([v.get('ContentDate', {}).get('Start') for v in values], utc=True),
+        'cloudCover': np.array([next((a['Value'] for a in v.get('Attributes', []) 
+                                      if a['Name'] == 'cloudCover'), np.nan)
+                                for v in values], dtype=float),
+        'footprint': gpd.GeoSeries.from_wkt(wkt, crs='EPSG:4326').values,
+    })
+
 
 def query_cdse(date_start, date_end, username, psw, 
                          data_collection = "S2MSI1C", shp = None,
                          max_cc = 90, tile = None, filter_date = True,
-                         filter_baseline = True, RON_list = None):
+                         filter_baseline = True, RON_list = None,
+                         published_after = None, min_cover = None,
+                         catalog = None, min_baseline = None):
     
     """Returns list of matching Sentinel-2 scenes for a selected period and
         for a specific area (defined from a shapefile). The username and
@@ -48,8 +100,9 @@ def query_cdse(date_start, date_end, username, psw,
             default is "S2MSI1C" that refers to the Sentinel-2 L1C data
         max_cc : int, optional
             maximum cloud coverage. Default is 90%
-        tile : str, optional
-            specific tile to be downloaded
+        tile : str or list, optional
+            specific tile(s) to be downloaded (e.g. '32TPS'). Filtered in 
+            the catalogue query
         filter_date : bool, optional
             whether to filter double dates, if their footprints overlap. 
             Keep the biggest footprint. Only for Sentinel-2
@@ -57,13 +110,31 @@ def query_cdse(date_start, date_end, username, psw,
             whether to filter double baseline for the same date. 
             Only for Sentinel-2
         RON_list : list, optional
-            whether to filter on a list of relative orbit numbers (RON).
+            whether to filter on a list of relative orbit numbers (RON),
+            e.g. ['R022', 'R065']. Filtered in the catalogue query. 
             Only for Sentinel-2
+        published_after : str, optional
+            only return products published in the catalogue after this 
+            timestamp (e.g. '2025-03-31T10:12:03.123Z'). Used for the delta
+            sync: reprocessed baselines are new publications and are returned
+        min_cover : float, optional
+            if given (e.g. 0.99), keep for each date and relative orbit only
+            the smallest set of tiles that covers this fraction of the AOI
+            (see get_min_cover). Only for Sentinel-2 and with a shapefile
+        catalog : str, optional
+            path of a local GeoParquet catalog. The catalogue response 
+            (before the filters) is upserted into it and can be queried 
+            offline with catalog.query_catalog_cdse. Only for Sentinel-2
+        min_baseline : str or float, optional
+            oldest processing baseline to return (e.g. 'N0500' or 5.0). 
+            Filtered in the catalogue query. Only for Sentinel-2
         
         Returns
         -------
         products : list
-            list of the matching scenes
+            list of the matching scenes (see parse_products for the columns).
+            products.attrs['watermark'] holds the latest PublicationDate 
+            seen in the catalogue response
     """   
     
     # Define supported data collections
@@ -144,25 +215,6 @@ def query_cdse(date_start, date_end, username, psw,
                             "T00:00:00.000Z and ContentDate/Start lt ",
                             date_end,
                             "T00:00:00.000Z&$top=1000"])
-        if tile:   
-            query = ('').join([f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products?$filter=",
-                               "contains(Name,'",
-                               tile,
-                               "') and Attributes/OData.CSC.StringAttribute/any(att:att/Name eq 'productType'",
-                               " and att/OData.CSC.StringAttribute/Value eq '",
-                               data_collection,
-                               "')",
-                               " and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'cloudCover'",
-                               " and att/OData.CSC.DoubleAttribute/Value lt ",
-                                str(max_cc),
-                                ") and OData.CSC.Intersects(area=geography'SRID=4326;",
-                                boundsdata,
-                                "') and ContentDate/Start gt ",
-                                date_start,
-                                "T00:00:00.000Z and ContentDate/Start lt ",
-                                date_end,
-                                "T00:00:00.000Z&$top=1000"])
-            
             
     elif data_collection in ["LANDSAT-5","LANDSAT-7","LANDSAT-8-ESA"]:
         query = ('').join([
@@ -178,22 +230,62 @@ def query_cdse(date_start, date_end, username, psw,
 
         
 
-    json = requests.get(query).json()
+    # ---- Push the tile, orbit and baseline selections into the query ----
+    if tile:
+        tiles = [tile] if isinstance(tile, str) else list(tile)
+        query = query.replace("&$top=", " and (%s)&$top=" % 
+                              ' or '.join("contains(Name,'%s')" % t for t in tiles))
+        
+    if RON_list and data_collection in ["S2MSI1C", "S2MSI2A"]:
+        orbits = ' or '.join("att/OData.CSC.IntegerAttribute/Value eq %i" % int(str(r).lstrip('R'))
+                             for r in RON_list)
+        query = query.replace("&$top=", "".join([
+            " and Attributes/OData.CSC.IntegerAttribute/any(att:att/Name eq 'relativeOrbitNumber'",
+            " and (", orbits, "))&$top="]))
+        
+    if min_baseline and data_collection in ["S2MSI1C", "S2MSI2A"]:
+        query = query.replace("&$top=", "".join([
+            " and Attributes/OData.CSC.DoubleAttribute/any(att:att/Name eq 'processingBaseline'",
+            " and att/OData.CSC.DoubleAttribute/Value ge %.2f)&$top=" % baseline_number(min_baseline)]))
+
+    # ---- Delta sync: only products published after the watermark ----
+    if published_after:
+        query = query.replace("&$top=", " and PublicationDate gt %s&$top=" % published_after)
+
+    # only the fields used downstream; the attributes hold the cloud cover
+    query += "&$select=" + ','.join(CATALOGUE_FIELDS) + "&$expand=Attributes"
+
+    # follow the result pages (at most 1000 products each)
+    pages = []
+    while query:
+        response = requests.get(query)
+        response.raise_for_status()
+        page = response.json()
+        pages.append(parse_products(page['value']))
+        query = page.get('@odata.nextLink')
+    
+    products = pd.concat(pages, ignore_index=True)
     
-    products = pd.DataFrame.from_dict(json['value'])
+    # keep the full response in the local catalog for offline queries
+    if catalog and data_collection in ["S2MSI1C", "S2MSI2A"]:
+        update_catalog(catalog, products, 'S2')
+    
+    # latest publication seen (before the filters): next delta sync starts here
+    watermark = (products['PublicationDate'].max().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+                 if not products.empty else published_after)
     
     if data_collection in ["S2MSI1C", "S2MSI2A"]:
-        # ---- Filter by processing baseline (keep newest) ----
-        if filter_baseline and not products.empty:
-            products = get_filtered_baseline(products)
-
-        # ---- Filter by geometry overlap (same date, same scene, keep the biggest) ----
-        if filter_date and not products.empty:
-            products = get_filtered_date(products)
-
-        # ---- Filter by RON ----
-        if RON_list:
-            products = filter_RON(products, RON_list)
+        # ---- Newest baseline, footprint overlap (keep the biggest), RON ----
+        products = filter_products(products, baseline = filter_baseline,
+                                   footprint = filter_date, RON_list = RON_list,
+                                   tiles = tile, min_baseline = min_baseline)
+
+        # ---- Minimal set of tiles covering the AOI (per date and orbit) ----
+        if min_cover and shp is not None and not products.empty:
+            groups = [f.split('_')[2][:8] + '_' + f.split('_')[4] for f in products['Name']]
+            products = get_min_cover(products, gdf.union_all(), 
+                                     products['footprint'],
+                                     groups, coverage=min_cover)
 
             
 
@@ -213,12 +305,17 @@ def query_cdse(date_start, date_end, username, psw,
     
     print('='*60 + '\n')
 
+    products.attrs['watermark'] = watermark
     
     return products
 
 
 
-def download_cdse(s2List, outdir, username, psw):
+def download_cdse(s2List, outdir, username, psw, band_patterns=None,
+                  store_dir=None, reserve_gb=None, priority='catalogue',
+                  preferred_missions=None, max_gb=None, max_products=None,
+                  deadline=None, concurrency=None, extractor=None, segments=1,
+                  disk_writer=None, inventory=None, postponed=None):
     """Downloads a list of Sentinel-2 given as input. Credentials 
         from CDSE: please check
         
@@ -236,6 +333,64 @@ def download_cdse(s2List, outdir, username, psw):
         username of your CDSE account
     psw : str
         password of your CDSE account
+    band_patterns : list, optional
+        glob patterns (str) of the SAFE files to retrieve, e.g. 
+        ['*_B03.jp2', '*_B11.jp2', '*_SCL_20m.jp2', 'MTD_*.xml']. Only the
+        matching entries are read from the remote zip (HTTP Range requests)
+        and saved as a sparse SAFE folder: outdir/Sentinel2/TILE/NAME.SAFE/.
+        If None or empty, the full zip is downloaded
+    store_dir : str, optional
+        root of a global product store shared by several output directories.
+        Full zips found in the store (same Name and MD5) are hard-linked 
+        (or reflinked) instead of downloaded, and new downloads are verified
+        and added to the store. Not used with band_patterns
+    reserve_gb : float, optional
+        if given, the expected download volume (ContentLength) is compared
+        with the free space in outdir and the queue is limited to the
+        products that fit, keeping reserve_gb GB free. Products that do not
+        fit are postponed (and returned as failed)
+    priority : str, optional
+        download order: 'catalogue' (default), 'cloud', 'newest', 'oldest'
+        or 'round_robin' (per tile). See download_queue.prioritize
+    preferred_missions : list, optional
+        missions (e.g. ['S2B']) downloaded before the others
+    max_gb : float, optional
+        maximum volume to download in this run, in GB
+    max_products : int, optional
+        maximum number of products to download in this run
+    deadline : float, optional
+        wall-clock deadline (time.time() value). No new download is started
+        after it
+    concurrency : dict, optional
+        parallel downloads, e.g. {'min': 1, 'max': 8, 'start': 2}: the
+        number of concurrent downloads follows the measured throughput and
+        backs off on throttling (see transfer.ConcurrencyTuner). If None,
+        the products are downloaded one at a time
+    extractor : extraction.Extractor, optional
+        post-download extraction stage: every zip is extracted on a process
+        pool (into Sentinel2/TILE/NAME.SAFE) while the next products 
+        download. Extracted products count as downloaded. Not used with
+        band_patterns
+    segments : int, optional
+        number of parallel connections (byte ranges) per archive, for large
+        archives whose single stream is slower than the link. Default is 1
+    disk_writer : dict, optional
+        writer stage decoupled from the network reads, e.g. 
+        {'threads': 2, 'buffer_mb': 256}: the downloads queue what they
+        receive (at most buffer_mb MB) and writer threads write it to disk
+        (see transfer.DiskWriter). If None, each download writes its chunks
+    inventory : inventory.Inventory, optional
+        listing of outdir used to skip the products already downloaded or
+        extracted. If None, outdir is scanned once (no per-product stat)
+    postponed : list, optional
+        if given, the names of the products postponed (budgets, disk 
+        reserve, deadline) are appended to it. They are also returned as
+        failed
+    
+    Returns
+    -------
+    failed : list
+        names of the products that could not be downloaded
     
     """
     
@@ -263,7 +418,7 @@ def download_cdse(s2List, outdir, username, psw):
     
 
 
-    def download_file(s2_id, access_token, outname):
+    def download_file(s2_id, access_token, outname, on_read=None):
         url = ('').join([f"https://zipper.dataspace.copernicus.eu/odata/v1/Products(",
                         s2_id,
                         ")/$value"])
@@ -273,21 +428,84 @@ def download_cdse(s2List, outdir, username, psw):
         session = requests.Session()
         session.headers.update(headers)
         response = session.get(url, headers=headers, stream=True)
+        response.raise_for_status()
         
-        with open(outname, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    file.write(chunk)
+        # large archives are fetched over several connections (byte ranges)
+        def open_range(start, end):
+            return session.get(url, headers={'Range': f'bytes={start}-{end}'}, stream=True)
+        
+        fetch_to_file(response, open_range, outname, segments, on_read, writer)
                     
-    # fake time token
-    time_token = datetime.strptime("1991-06-29", "%Y-%m-%d")
-    for i in tqdm(range(0, len(s2List))):
-        time_refresh = (datetime.now() - time_token).total_seconds()
+    failed = []
+    skipped = []
+    
+    # ---- Queue planning: priority order, budgets and free disk space ----
+    if not s2List.empty:
+        queue = pd.DataFrame({
+            'date': s2List['Name'].str.split('_').str[2],
+            'cloud': s2List['cloudCover'] if 'cloudCover' in s2List else np.nan,
+            'tile': s2List['Name'].str.split('_').str[5],
+            'mission': s2List['Name'].str[:3],
+        })
+        s2List = s2List.iloc[prioritize(queue, priority, preferred_missions)]
+        s2List = s2List.reset_index(drop=True)
         
-        if time_refresh >= 600:
-            print("Refreshing token")
-            access_token, time_token = get_access_token(username, psw)
-
+        # products still to be downloaded (one scan of the output tree)
+        if inventory is None:
+            inventory = Inventory(outdir)
+        has_safe = inventory.has_dir(s2List['Name'])
+        has_zip = inventory.has_file(s2List['Name'].str.replace('.SAFE', '.zip'))
+        if band_patterns:
+            # sparse SAFEs: complete only if their marker lists every pattern
+            has_safe = inventory.has_bands(s2List['Name'], band_patterns)
+        extracted = set(s2List.loc[has_safe, 'Name'])
+        archived = set(s2List.loc[has_zip, 'Name'])
+        if band_patterns:
+            pending = ~has_safe
+        else:
+            pending = ~(has_zip | (has_safe & (extractor is not None)))
+        sizes = s2List['ContentLength'].to_numpy()
+        
+        keep = np.ones(len(s2List), dtype=bool)
+        if max_gb is not None or max_products is not None:
+            keep[pending] = apply_budget(sizes[pending], max_gb, max_products)
+        if reserve_gb is not None:
+            keep[keep & pending] = plan_downloads(sizes[keep & pending], outdir,
+                                                  reserve_gb * 1024**3)
+            
+        failed.extend(s2List.loc[~keep, 'Name'].tolist())
+        skipped.extend(s2List.loc[~keep, 'Name'].tolist())
+        s2List = s2List[keep].reset_index(drop=True)
+    
+    # the access token is shared by the parallel downloads and refreshed 
+    # when it is older than 10 minutes (fake time token to start with)
+    token = {'access_token': None,
+             'time_token': datetime.strptime("1991-06-29", "%Y-%m-%d")}
+    token_lock = threading.Lock()
+    
+    def current_token():
+        with token_lock:
+            time_refresh = (datetime.now() - token['time_token']).total_seconds()
+            if time_refresh >= 600:
+                print("Refreshing token")
+                token['access_token'], token['time_token'] = get_access_token(username, psw)
+            return token['access_token']
+    
+    # number of parallel downloads: fixed (1) or adapted to the throughput
+    if concurrency:
+        tuner = ConcurrencyTuner(concurrency.get('min', 1), concurrency.get('max', 8),
+                                 concurrency.get('start'), label='Sentinel-2 downloads')
+    else:
+        tuner = ConcurrencyTuner(1, 1)
+    
+    # disk writes decoupled from the network reads
+    writer = DiskWriter(disk_writer.get('threads', 2), disk_writer.get('buffer_mb', 256)) \
+        if disk_writer else None
+    
+    def process(i):
+        """
+        Download product i of s2List. Returns 'done', 'failed' or 'postponed'.
+        """
         fileName = s2List.loc[i]['Name']
         s2_id = s2List.loc[i]['Id']
 
@@ -296,30 +514,145 @@ def download_cdse(s2List, outdir, username, psw):
             tile = fileName.split('_')[5]
         except IndexError:
             print(f"Error parsing tile for {fileName}")
-            continue
+            return 'done'
         
         # Build new folder path: outdir/Sentinel2/TxxXYZ/
         scene_dir = os.path.join(outdir, 'Sentinel2', tile)
-        os.makedirs(scene_dir, exist_ok=True)
-        
         outname = os.path.join(scene_dir, fileName.replace('.SAFE', '.zip'))
+        
+        if band_patterns:
+            if fileName in extracted:
+                print('%s already downloaded' %fileName)
+                return 'done'
+            
+            os.makedirs(scene_dir, exist_ok=True)
+            with tuner:
+                if deadline_passed(deadline):
+                    return 'postponed'
+                print("Downloading bands of %s" %fileName)
+                try:
+                    download_bands(s2_id, current_token(), scene_dir, band_patterns,
+                                   on_read=tuner.record)
+                    mark_extracted(scene_dir, fileName, band_patterns)
+                except Exception as e:
+                    print('Error: %s' %e)
+                    if is_throttled(e):
+                        raise
+                    return 'failed'
+            return 'done'
                 
-        if os.path.exists(outname) and os.stat(outname).st_size>0:
+        if extractor is not None and fileName in extracted:
+            print('%s already extracted' %fileName)
+            return 'done'
+        
+        if fileName in archived:
             print('%s already downloaded' %fileName.replace('.SAFE','.zip'))
+            if extractor is not None:
+                extractor.submit(outname)
+            return 'done'
         
-        else:
+        os.makedirs(scene_dir, exist_ok=True)
+        
+        md5 = get_md5(s2List.loc[i]['Checksum']) if 'Checksum' in s2List else None
+        
+        if store_dir:
+            stored = store_lookup(store_dir, 'sentinel2', fileName,
+                                  os.path.basename(outname), md5)
+            if stored:
+                method = clone_file(stored, outname)
+                print('%s taken from the product store (%s)' %(os.path.basename(outname), method))
+                if extractor is not None:
+                    extractor.submit(outname)
+                return 'done'
+        
+        with tuner:
+            if deadline_passed(deadline):
+                return 'postponed'
             print("Downloading %s" %fileName)
             try:
-                download_file(s2_id, access_token, outname)
-            except:
-                print('Error')
+                download_file(s2_id, current_token(), outname, on_read=tuner.record)
+            except Exception as e:
+                print('Error: %s' %e)
+                # a throttling error must reach the tuner
+                if is_throttled(e):
+                    raise
+                return 'failed'
+        
+        if store_dir:
+            store_add(store_dir, 'sentinel2', fileName, outname, md5)
+        
+        # hand the zip over to the extraction stage
+        if extractor is not None:
+            extractor.submit(outname)
+        return 'done'
+    
+    def run(i):
+        try:
+            return process(i)
+        except Exception:
+            return 'failed'
+    
+    n_late = 0
+    with ThreadPoolExecutor(max_workers=tuner.max_workers) as pool:
+        futures = {pool.submit(run, i): i for i in range(len(s2List))}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            status = future.result()
+            if status != 'done':
+                failed.append(s2List.loc[futures[future]]['Name'])
+            if status == 'postponed':
+                skipped.append(s2List.loc[futures[future]]['Name'])
+                n_late += 1
+    if writer is not None:
+        writer.close()
+    
+    if n_late:
+        print("Deadline reached: %i products postponed" %n_late)
+    if postponed is not None:
+        postponed.extend(skipped)
+    
+    return failed
 
-     
 
 
 
+def download_bands(s2_id, access_token, scene_dir, band_patterns, on_read=None):
+    """
+    Retrieve only the SAFE entries matching band_patterns from the CDSE 
+    zipper, reading the zip central directory and the selected entries 
+    with HTTP Range requests.
+    
+    Parameters
+    ----------
+    s2_id : str
+        CDSE product Id
+    access_token : str
+        CDSE access token
+    scene_dir : str
+        tile folder (outdir/Sentinel2/TILE) where the sparse SAFE is saved
+    band_patterns : list
+        glob patterns (str) of the SAFE files to retrieve
+    on_read : callable, optional
+        called with the number of bytes transferred
+    
+    Returns
+    -------
+    members : list
+        names of the retrieved entries
+    """
+    url = ('').join([f"https://zipper.dataspace.copernicus.eu/odata/v1/Products(",
+                    s2_id,
+                    ")/$value"])
+    
+    session = requests.Session()
+    session.headers.update({"Authorization": f"Bearer {access_token}"})
+    
+    members, nbytes = extract_remote_zip(url, scene_dir, band_patterns, session)
+    print("Retrieved %i files (%.1f MB)" %(len(members), nbytes / 1024**2))
+    if on_read:
+        on_read(nbytes)
+    
+    return members
 
- 
 
 
 
@@ -6,8 +6,10 @@ Created on Thu Oct 16 09:01:27 2025
 @author: vpremier
 """
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import box, shape
 
 
@@ -109,7 +111,7 @@ def get_filtered_date(products):
     products : pandas.DataFrame
         DataFrame containing at least:
         - 'Name' : full Sentinel-2 product name
-        - 'GeoFootprint' : dict-like GeoJSON footprint (Polygon geometry)
+        - 'footprint' : shapely footprint (EPSG:4326)
 
     Returns
     -------
@@ -130,9 +132,8 @@ def get_filtered_date(products):
     duplicates = products[products["commonName"].duplicated(keep=False)]
     duplicates = duplicates.sort_values(by=["commonName", "Name"])
 
-    # --- 3️⃣ Convert GeoJSON footprints to Shapely geometries ---
-    duplicates["geometry"] = duplicates["GeoFootprint"].apply(shape)
-    gdf = gpd.GeoDataFrame(duplicates, geometry="geometry", crs="EPSG:4326")
+    # --- 3️⃣ Footprints of the duplicates (already shapely geometries) ---
+    gdf = gpd.GeoDataFrame(duplicates, geometry="footprint", crs="EPSG:4326")
 
     # --- 4️⃣ Loop through each group of duplicates to remove near-identical geometries ---
     keep_rows = []
@@ -258,3 +259,204 @@ def filter_RON(products, RON_list):
       
 
 
+
+
+def get_min_cover(products, aoi, footprints, groups, coverage=0.99):
+    """
+    Keep, for each acquisition (e.g. date and relative orbit), the smallest
+    set of footprints that covers the AOI.
+
+    Within each group, footprints are picked greedily (largest new covered
+    area of the AOI first) until the selection covers the requested fraction
+    of the AOI area that the whole group covers. Footprints that do not 
+    intersect the AOI are removed. Areas are computed in an equal-area 
+    projection (EPSG:6933). Works for Sentinel-2 tiles and Landsat scenes.
+    Products without a footprint (None) cannot be checked and are kept.
+
+    Parameters
+    ----------
+    products : pandas.DataFrame
+        query results (e.g. output of query_cdse or query_landsat)
+    aoi : shapely geometry
+        area of interest, in EPSG:4326
+    footprints : list-like
+        shapely footprints (EPSG:4326) of the products, in the same order
+        (None if unknown)
+    groups : list-like
+        acquisition key of each product (e.g. '20240704_R022' for Sentinel-2,
+        '20240704_192' (date and path) for Landsat)
+    coverage : float, optional
+        fraction of the coverable AOI area to reach. Default is 0.99
+
+    Returns
+    -------
+    products_fltd : pandas.DataFrame
+        the products of the minimal covers
+    """
+
+    # --- 1️⃣ Project AOI and footprints to an equal-area CRS ---
+    aoi = gpd.GeoSeries([aoi], crs="EPSG:4326").to_crs("EPSG:6933").iloc[0]
+    geoms = gpd.GeoSeries(list(footprints), crs="EPSG:4326").to_crs("EPSG:6933")
+
+    # --- 2️⃣ Part of the AOI covered by each footprint ---
+    parts = geoms.intersection(aoi)
+    
+    # no footprint: the coverage is unknown, the product is kept
+    keep_rows = [p for p in range(len(products)) if parts.iloc[p] is None]
+    if keep_rows:
+        print(f"Minimal cover filter: {len(keep_rows)} scenes without footprint kept")
+    
+    for _, pos in pd.Series(range(len(products))).groupby(list(groups)):
+        candidates = [p for p in pos if parts.iloc[p] is not None and not parts.iloc[p].is_empty]
+        if not candidates:
+            continue
+        
+        # area of the AOI covered by the whole group
+        target = gpd.GeoSeries(parts.iloc[candidates].values).union_all().area
+        
+        # --- 3️⃣ Greedy cover: add the footprint with the largest gain ---
+        covered = None
+        while candidates and (covered is None or covered.area < coverage * target):
+            if covered is None:
+                gains = [parts.iloc[p].area for p in candidates]
+            else:
+                gains = [parts.iloc[p].difference(covered).area for p in candidates]
+            best = max(range(len(candidates)), key=gains.__getitem__)
+            if gains[best] <= 0:
+                break
+            p = candidates.pop(best)
+            covered = parts.iloc[p] if covered is None else covered.union(parts.iloc[p])
+            keep_rows.append(p)
+
+    products_fltd = products.iloc[sorted(keep_rows)]
+
+    before = len(products)
+    after = len(products_fltd)
+    removed = before - after
+
+    print(f"Minimal cover filter: removed {removed} scenes "
+          f"({after}/{before} remaining)")
+
+    products_fltd = products_fltd.reset_index(drop=True)
+
+    return products_fltd
+
+
+
+
+def filter_products(products, baseline=True, footprint=True, RON_list=None,
+                    tiles=None, missions=None, max_cc=None, min_baseline=None,
+                    tol=0.95):
+    """
+    Run the Sentinel-2 product filters in a single pass over the table.
+
+    The product names are parsed once and every stage updates a shared 
+    boolean mask; the table is copied only once, at the end. The stages
+    give the same result as the chain get_filtered_baseline, 
+    get_filtered_date, filter_RON (used by query_cdse before), plus 
+    optional tile, mission and cloud cover stages.
+
+    Parameters
+    ----------
+    products : pandas.DataFrame
+        products with at least 'Name', plus 'footprint' (shapely 
+        geometries, EPSG:4326) for the footprint stage and 'cloudCover' for
+        the cloud cover stage (e.g. output of query_cdse)
+    baseline : bool, optional
+        keep only the newest processing baseline per scene. Default is True
+    footprint : bool, optional
+        remove near-identical footprints of the same scene (overlap ratio 
+        >= tol), keeping the biggest one. Default is True
+    RON_list : list, optional
+        relative orbits to keep (e.g. ['R022', 'R051'] or [22, 51])
+    tiles : str or list, optional
+        tiles to keep (e.g. ['32TPS'] or ['T32TPS'])
+    missions : list, optional
+        missions to keep (e.g. ['S2A', 'S2B'])
+    max_cc : float, optional
+        maximum cloud cover (%)
+    min_baseline : str or float, optional
+        oldest processing baseline to keep (e.g. 'N0500' or 5.0)
+    tol : float, optional
+        overlap tolerance of the footprint stage. Default is 0.95
+
+    Returns
+    -------
+    products_fltd : pandas.DataFrame
+        the products that pass all the stages
+    """
+    before = len(products)
+    if before == 0:
+        return products.reset_index(drop=True)
+
+    # --- 1️⃣ Parse the names once (mission, level, date, baseline, RON, tile, ...) ---
+    parts = products["Name"].str.split("_", expand=True)
+    mask = np.ones(before, dtype=bool)
+    removed = {}
+
+    def restrict(stage, keep):
+        n = mask.sum()
+        mask[:] &= keep
+        removed[stage] = n - mask.sum()
+
+    # --- 2️⃣ Row-wise stages on the name fields ---
+    if missions:
+        restrict("mission", parts[0].isin(missions).to_numpy())
+    if tiles:
+        tiles = [tiles] if isinstance(tiles, str) else tiles
+        restrict("tile", parts[5].str.lstrip("T").isin([t.lstrip("T") for t in tiles]).to_numpy())
+    if RON_list:
+        orbits = ["R%03d" % int(str(r).lstrip("R")) for r in RON_list]
+        restrict("RON", parts[4].isin(orbits).to_numpy())
+    if min_baseline:
+        if not isinstance(min_baseline, str):
+            min_baseline = "N%04d" % round(float(min_baseline) * 100)
+        restrict("min. baseline", (parts[3] >= min_baseline).to_numpy())
+
+    # scene identifier ignoring baseline and generation time (as commonName)
+    scene = parts.groupby([0, 1, 2, 4, 5], sort=False).ngroup().to_numpy()
+
+    # --- 3️⃣ Newest baseline per scene ---
+    if baseline:
+        base = pd.DataFrame({"scene": scene, "baseline": parts[3].to_numpy(), 
+                             "name": products["Name"].to_numpy()})[mask]
+        multi = base.groupby("scene")["baseline"].transform("nunique") > 1
+        # scenes with several baselines keep a single product: the last by
+        # name, i.e. the newest baseline (and generation time)
+        last = ~base.sort_values("name").duplicated("scene", keep="last")
+        keep = ~multi | last.sort_index()
+        full = np.zeros(before, dtype=bool)
+        full[base.index[keep.to_numpy()]] = True
+        restrict("baseline", full)
+
+    # --- 4️⃣ Near-identical footprints of the same scene ---
+    if footprint:
+        pos = np.flatnonzero(mask)
+        dup = pd.DataFrame({"scene": scene[pos], "pos": pos})
+        dup = dup[dup["scene"].duplicated(keep=False)]
+        if not dup.empty:
+            names = products["Name"].to_numpy()
+            pairs = dup.merge(dup, on="scene")
+            pairs = pairs[names[pairs["pos_x"]] < names[pairs["pos_y"]]]
+            geoms = np.asarray(products["footprint"], dtype=object)
+            g1, g2 = geoms[pairs["pos_x"]], geoms[pairs["pos_y"]]
+            a1, a2 = shapely.area(g1), shapely.area(g2)
+            overlap = shapely.area(shapely.intersection(g1, g2)) / np.minimum(a1, a2)
+            # keep the larger footprint of each overlapping pair
+            drop = np.where(a1 >= a2, pairs["pos_y"], pairs["pos_x"])[overlap >= tol]
+            keep = np.ones(before, dtype=bool)
+            keep[drop] = False
+            restrict("footprint", keep)
+
+    # --- 5️⃣ Cloud cover ---
+    if max_cc is not None:
+        restrict("cloud", (products["cloudCover"] <= max_cc).to_numpy())
+
+    products_fltd = products[mask].reset_index(drop=True)
+
+    after = len(products_fltd)
+    stages = ", ".join(f"{k}: -{v}" for k, v in removed.items())
+    print(f"Product filters: removed {before - after} scenes "
+          f"({after}/{before} remaining; {stages})")
+
+    return products_fltd
@@ -0,0 +1,88 @@
+import http.server
+import json
+import os
+import threading
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+from landsat_stac import download_landsat_stac
+
+
+SCENES = ['LC08_L1TP_192028_20230101_20230110_02_T1',
+          'LC09_L1TP_192028_20230109_20230110_02_T1',
+          'LC08_L1TP_193028_20230108_20230110_02_T1']
+FILES = ['B3.TIF', 'B6.TIF', 'MTL.txt']
+
+
+class StacHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local STAC stand-in: one item per page. Page 1 links to page 2 with a
+    POST merge link (only the paging token in the body), page 2 links to 
+    page 3 with a GET link.
+    """
+    def log_message(self, *args):
+        pass
+
+    def send(self, data, content_type='application/json'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def page(self, ids, token):
+        root = f"http://127.0.0.1:{self.server.server_port}"
+        n = {None: 0, 'p2': 1, 'p3': 2}[token]
+        features = [{'id': i, 'assets': {
+                        f.split('.')[0].lower(): {'href': f"{root}/files/{i}_{f}", 'file:size': 1000}
+                        for f in FILES}}
+                    for i in SCENES[n:n + 1] if i in ids]
+        links = []
+        if n == 0:
+            links.append({'rel': 'next', 'href': f"{root}/search", 'method': 'POST',
+                          'body': {'token': 'p2'}, 'merge': True})
+        elif n == 1:
+            links.append({'rel': 'next', 'href': f"{root}/search?ids={','.join(ids)}&token=p3"})
+        self.send(json.dumps({'type': 'FeatureCollection', 'features': features,
+                              'links': links}).encode())
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        # a merged body keeps the ids and the collection of the first request
+        assert body['collections'] == ['landsat-c2l1']
+        self.page(body['ids'], body.get('token'))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/search':
+            query = parse_qs(url.query)
+            self.page(query['ids'][0].split(','), query['token'][0])
+        else:
+            self.send(os.path.basename(url.path).encode() * 100, 'image/tiff')
+
+
+@pytest.fixture
+def stac_url():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StacHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+def test_download_landsat_stac(tmp_path, stac_url):
+    results = pd.DataFrame({'displayId': SCENES, 'cloudCover': [1, 2, 3]})
+    failed = download_landsat_stac(results, str(tmp_path), ['*_B6.TIF', '*_MTL.txt'],
+                                   stac_url=stac_url, max_workers=2)
+    assert failed == []
+
+    for scene in SCENES:
+        sensor, pathrow = scene.split('_')[0], scene.split('_')[2]
+        files = set(os.listdir(tmp_path / 'Landsat' / sensor / pathrow))
+        assert {scene + '_B6.TIF', scene + '_MTL.txt'} <= files
+        assert scene + '_B3.TIF' not in files
+
+    entries = [name for _, dirs, files in os.walk(tmp_path) for name in dirs + files]
+    assert not [name for name in entries if name.endswith('.partial')]
+    assert not [name for name in entries if name.endswith('_B3.TIF')]
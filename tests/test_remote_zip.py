@@ -0,0 +1,104 @@
+import http.server
+import os
+import threading
+import zipfile
+
+import pytest
+
+from remote_zip import HttpRangeFile, extract_remote_zip
+
+
+SAFE = 'S2A_MSIL1C_20230101T101031_N0509_R022_T32TPS_20230101T000000.SAFE'
+ENTRIES = {f'{SAFE}/MTD_MSIL1C.xml': b'<xml/>' * 100,
+           f'{SAFE}/GRANULE/L1C_T32TPS/IMG_DATA/T32TPS_B03.jp2': os.urandom(300000),
+           f'{SAFE}/GRANULE/L1C_T32TPS/IMG_DATA/T32TPS_B11.jp2': os.urandom(300000),
+           f'{SAFE}/GRANULE/L1C_T32TPS/IMG_DATA/T32TPS_B12.jp2': os.urandom(300000)}
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Local stand-in of the CDSE zipper: serves server.data with Range 
+    support (or ignores the Range header if server.ranges is False), and 
+    fails every request after server.fail_after requests.
+    """
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        if server.fail_after is not None and server.requests > server.fail_after:
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        data = server.data
+        range_header = self.headers.get('Range')
+        if not server.ranges or not range_header:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            return
+        start, end = (int(v) for v in range_header.split('=')[1].split('-'))
+        end = min(end, len(data) - 1)
+        self.send_response(206)
+        self.send_header('Content-Range', f'bytes {start}-{end}/{len(data)}')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        self.wfile.write(data[start:end + 1])
+
+
+@pytest.fixture
+def server(tmp_path):
+    path = tmp_path / 'product.zip'
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as z:
+        for name, data in ENTRIES.items():
+            z.writestr(name, data)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.data = path.read_bytes()
+    server.ranges = True
+    server.fail_after = None
+    server.requests = 0
+    server.url = f"http://127.0.0.1:{server.server_port}/product.zip"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def files(folder):
+    return sorted(os.path.relpath(os.path.join(root, f), folder).replace(os.sep, '/')
+                  for root, _, names in os.walk(folder) for f in names)
+
+
+def test_extract_selected_entries(tmp_path, server):
+    dest = tmp_path / 'T32TPS'
+    members, nbytes = extract_remote_zip(server.url, str(dest), ['*_B03.jp2', 'MTD_*.xml'])
+
+    expected = [f'{SAFE}/GRANULE/L1C_T32TPS/IMG_DATA/T32TPS_B03.jp2', f'{SAFE}/MTD_MSIL1C.xml']
+    assert sorted(members) == expected
+    assert files(dest) == expected
+    for name in expected:
+        assert (dest / name).read_bytes() == ENTRIES[name]
+    # the other bands are not transferred
+    assert nbytes < len(server.data) - 2 * 300000
+
+    # new patterns: merged into the existing SAFE
+    extract_remote_zip(server.url, str(dest), ['*_B11.jp2'])
+    assert len(files(dest)) == 3
+
+
+def test_failed_read_leaves_no_partial_folder(tmp_path, server):
+    dest = tmp_path / 'T32TPS'
+    for fail_after in (3, 4):
+        server.requests = 0
+        server.fail_after = fail_after
+        with pytest.raises(Exception):
+            extract_remote_zip(server.url, str(dest), ['*.jp2'])
+    assert os.listdir(dest) == []
+
+
+def test_range_support_is_required(server):
+    server.ranges = False
+    with pytest.raises(IOError):
+        HttpRangeFile(server.url)
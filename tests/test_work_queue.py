@@ -0,0 +1,110 @@
+import json
+import multiprocessing
+import os
+import time
+
+from work_queue import (claim, failed_attempts, is_published, publish_queue,
+                        queue_path, release, renew, run_worker)
+
+
+def _handler(record_dir):
+    def handler(items):
+        for item in items:
+            # one line per processing of a product
+            with open(os.path.join(record_dir, item['Name']), 'a') as f:
+                f.write(f"{os.getpid()}\n")
+        time.sleep(0.05)
+        return [], []
+    return handler
+
+
+def _worker(queue_dir, record_dir):
+    run_worker(queue_dir, _handler(record_dir), batch_size=2, lease_seconds=5,
+               poll_seconds=0.1)
+
+
+def test_workers_process_each_product_once(tmp_path):
+    queue_dir = str(tmp_path / 'queue')
+    record_dir = tmp_path / 'records'
+    record_dir.mkdir()
+    keys = [f"P{i:03d}" for i in range(40)]
+    publish_queue(queue_dir, [{'Name': k} for k in keys], 'Name')
+
+    # lease of a crashed worker, expired: taken over by one of the workers
+    lock = os.path.join(queue_dir, 'locks', 'P000.lock')
+    with open(lock, 'w') as f:
+        json.dump({'host': 'crashed', 'pid': 1, 'token': 'crashed'}, f)
+    os.utime(lock, (time.time() - 60, time.time() - 60))
+
+    ctx = multiprocessing.get_context('spawn')
+    workers = [ctx.Process(target=_worker, args=(queue_dir, str(record_dir)))
+               for _ in range(4)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join(60)
+        assert w.exitcode == 0
+
+    for k in keys:
+        assert (record_dir / k).read_text().count('\n') == 1, k
+    assert sorted(os.listdir(os.path.join(queue_dir, 'done'))) == keys
+    assert os.listdir(os.path.join(queue_dir, 'locks')) == []
+
+
+def test_lease_ownership(tmp_path):
+    queue_dir = str(tmp_path)
+    publish_queue(queue_dir, [{'Name': 'A'}], 'Name')
+
+    token = claim(queue_dir, 'A', lease_seconds=60)
+    assert token is not None
+    assert claim(queue_dir, 'A', lease_seconds=60) is None
+    assert not renew(queue_dir, 'A', 'other')
+    assert renew(queue_dir, 'A', token)
+
+    # a release with another token leaves the lock in place
+    release(queue_dir, 'A', 'other', 'postponed')
+    assert os.path.exists(os.path.join(queue_dir, 'locks', 'A.lock'))
+
+    # expired lease taken over: the old owner cannot renew or remove it
+    lock = os.path.join(queue_dir, 'locks', 'A.lock')
+    os.utime(lock, (time.time() - 120, time.time() - 120))
+    new_token = claim(queue_dir, 'A', lease_seconds=60)
+    assert new_token not in (None, token)
+    assert not renew(queue_dir, 'A', token)
+    release(queue_dir, 'A', token, 'failed')
+    assert os.path.exists(lock)
+    release(queue_dir, 'A', new_token, 'done')
+    assert not os.path.exists(lock)
+
+
+def test_postponed_products_are_not_failed_attempts(tmp_path):
+    queue_dir = str(tmp_path)
+    publish_queue(queue_dir, [{'Name': k} for k in 'ABC'], 'Name')
+    calls = []
+
+    def handler(items):
+        names = [item['Name'] for item in items]
+        calls.extend(names)
+        return [n for n in names if n in 'BC'], [n for n in names if n == 'C']
+
+    assert run_worker(queue_dir, handler, batch_size=3, poll_seconds=0.1) == 1
+    # B is retried max_attempts times, C is postponed once (not retried)
+    assert calls.count('B') == 3 and failed_attempts(queue_dir, 'B') == 3
+    assert calls.count('C') == 1 and failed_attempts(queue_dir, 'C') == 0
+    assert not os.listdir(os.path.join(queue_dir, 'locks'))
+    assert os.listdir(os.path.join(queue_dir, 'done')) == ['A']
+
+
+def test_queue_of_another_query(tmp_path):
+    query = {'date_start': '2025-01-01', 'tiles': ['32TPS']}
+    queue_dir = queue_path(str(tmp_path), 'sentinel2', query)
+    assert queue_dir != queue_path(str(tmp_path), 'sentinel2', dict(query, tiles=['32TQS']))
+
+    publish_queue(queue_dir, [{'Name': 'A'}], 'Name', query)
+    assert is_published(queue_dir, query)
+    try:
+        publish_queue(queue_dir, [{'Name': 'B'}], 'Name', dict(query, tiles=[]))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("a queue of another query was reused")
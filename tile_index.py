@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 24 14:52:18 2026
+
+@author: vpremier
+
+Offline tile grids: Sentinel-2 MGRS tiles and Landsat WRS-2 path/rows.
+An AOI is resolved locally to the tiles and path/rows it intersects, to
+fill s2_tile_list and landsat_tile_list.
+
+Both grids are computed, not downloaded:
+- MGRS: every 100 km MGRS square of a UTM zone is a Sentinel-2 tile of
+  109.8 km, anchored at the upper-left corner of the square (snapped to the
+  60 m grid) and extending east and south over the neighbouring squares.
+- WRS-2: scene centres and corners follow the nominal Landsat 8/9 orbit
+  (98.2 deg inclination, 233 paths in 16 days, 248 rows per orbit, row 60
+  at the descending node, path 1 descending node at 64.6 W). Footprints
+  are 185 x 180 km and are accurate to a few km.
+
+An official grid file (e.g. the Sentinel-2 tiling grid or the USGS
+WRS2_descending shapefile) can be given instead.
+"""
+
+import math
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from catalog import read_aoi
+
+
+# MGRS latitude bands (8 deg, X is 12 deg) and 100 km square letters
+BANDS = 'CDEFGHJKLMNPQRSTUVWX'
+COLUMN_LETTERS = ['STUVWXYZ', 'ABCDEFGH', 'JKLMNPQR']   # zone % 3
+ROW_LETTERS = 'ABCDEFGHJKLMNPQRSTUV'
+
+# WRS-2 orbit
+WRS2_INCLINATION = 98.2
+WRS2_PATHS = 233
+WRS2_ROWS = 248
+WRS2_PERIOD = 16 * 1440 / WRS2_PATHS    # minutes
+WRS2_PATH1_NODE = -64.6                 # longitude of the descending node
+EARTH_RADIUS = 6371.0
+WGS84_E2 = 0.00669438
+
+
+def band_limits(band):
+    """
+    Latitude range of an MGRS latitude band.
+    """
+    south = -80 + 8 * BANDS.index(band)
+    return south, 84 if band == 'X' else south + 8
+
+
+
+def zone_limits(zone, band):
+    """
+    Longitude range of a UTM zone within a latitude band (with the Norway
+    and Svalbard exceptions), or None if the zone does not exist there.
+    """
+    west = -180 + 6 * (zone - 1)
+    east = west + 6
+    if band == 'V' and zone == 31:
+        east = 3
+    elif band == 'V' and zone == 32:
+        west = 3
+    elif band == 'X':
+        if zone in (32, 34, 36):
+            return None
+        if zone in (31, 33, 35, 37):
+            west, east = {31: (0, 9), 33: (9, 21), 35: (21, 33), 37: (33, 42)}[zone]
+    return west, east
+
+
+
+@lru_cache(maxsize=None)
+def mgrs_zone_grid(zone, north):
+    """
+    Sentinel-2 tiles of a UTM zone and hemisphere.
+
+    Squares crossing a latitude band boundary are listed under both band
+    letters.
+
+    Returns
+    -------
+    grid : gpd.GeoDataFrame
+        columns name (e.g. '32TPS') and geometry (EPSG:4326)
+    """
+    epsg = (32600 if north else 32700) + zone
+    to_utm = Transformer.from_crs(4326, epsg, always_xy=True)
+    to_lonlat = Transformer.from_crs(epsg, 4326, always_xy=True)
+
+    # zone cells (one per latitude band) in UTM coordinates
+    bands = BANDS[10:] if north else BANDS[:10]
+    cells = {}
+    for band in bands:
+        limits = zone_limits(zone, band)
+        if limits is None:
+            continue
+        south, north_ = band_limits(band)
+        cell = shapely.segmentize(shapely.box(limits[0], south, limits[1], north_), 0.25)
+        cells[band] = shapely.transform(cell, lambda xy: np.column_stack(
+            to_utm.transform(xy[:, 0], xy[:, 1])))
+
+    columns = COLUMN_LETTERS[zone % 3]
+    row_offset = 0 if zone % 2 else 5
+    names, tiles = [], []
+    for northing in range(0 if north else 1000000, 9400000 if north else 10000000, 100000):
+        for i, easting in enumerate(range(100000, 900000, 100000)):
+            square = shapely.box(easting, northing, easting + 100000, northing + 100000)
+            letters = columns[i] + ROW_LETTERS[(northing // 100000 + row_offset) % 20]
+            for band, cell in cells.items():
+                if not cell.intersects(square) or cell.touches(square):
+                    continue
+                # 109.8 km tile, upper-left corner snapped to the 60 m grid
+                west = math.floor(easting / 60) * 60
+                top = math.ceil((northing + 100000) / 60) * 60
+                names.append('%02d%s%s' % (zone, band, letters))
+                tiles.append(shapely.box(west, top - 109800, west + 109800, top))
+
+    # longitudes continuous around the central meridian (antimeridian zones)
+    meridian = -183 + 6 * zone
+    def lonlat(xy):
+        lon, lat = to_lonlat.transform(xy[:, 0], xy[:, 1])
+        return np.column_stack([meridian + (lon - meridian + 180) % 360 - 180, lat])
+    tiles = shapely.transform(shapely.segmentize(np.array(tiles), 10000), lonlat)
+    return _wrap(gpd.GeoDataFrame({'name': names}, geometry=tiles, crs='EPSG:4326'))
+
+
+
+def mgrs_grid(bounds):
+    """
+    Sentinel-2 tiles of the UTM zones and hemispheres around bounds
+    (minx, miny, maxx, maxy, EPSG:4326).
+    """
+    minx, miny, maxx, maxy = bounds
+    # tiles reach up to ~110 km beyond their zone
+    margin = min(180, 1.0 / max(math.cos(math.radians(max(abs(miny), abs(maxy)))), 0.01))
+    lons = np.append(np.arange(minx - margin, maxx + margin, 3), maxx + margin)
+    zones = set(((lons + 180) % 360 // 6).astype(int) + 1)
+    if maxy > 55:
+        zones.update(z for z in (31, 32, 33, 35, 37) if minx - margin < 42 and maxx + margin > 0)
+
+    frames = [mgrs_zone_grid(zone, north)
+              for zone in sorted(zones) for north in (True, False)
+              if (maxy > -1 if north else miny < 1)]
+    return pd.concat(frames, ignore_index=True)
+
+
+
+@lru_cache(maxsize=None)
+def wrs2_grid():
+    """
+    WRS-2 descending (daytime) path/rows.
+
+    Returns
+    -------
+    grid : gpd.GeoDataFrame
+        columns name (PPPRRR, e.g. '192028') and geometry (EPSG:4326)
+    """
+    inc = math.radians(WRS2_INCLINATION)
+    rows = np.arange(1, WRS2_ROWS + 1)
+    u_rows = 180 + (rows - 60) * 360 / WRS2_ROWS
+    u_rows = np.where(u_rows > 360, u_rows - 360, u_rows)
+    rows = rows[(u_rows % 360 >= 90) & (u_rows % 360 <= 270)]
+    paths = np.arange(1, WRS2_PATHS + 1)
+    path, row = [a.ravel() for a in np.meshgrid(paths, rows, indexing='ij')]
+
+    # corners and edge midpoints: along-track +-90 km, cross-track +-92.5 km
+    along = np.array([-1, 0, 1, 1, 1, 0, -1, -1]) * 90 / EARTH_RADIUS
+    cross = np.array([-1, -1, -1, 0, 1, 1, 1, 0]) * 92.5 / EARTH_RADIUS
+    u = np.radians(180 + (row[:, None] - 60) * 360 / WRS2_ROWS) + along
+    c = np.broadcast_to(cross, u.shape)
+
+    x = np.cos(c) * np.cos(u)
+    y = np.cos(c) * np.sin(u) * math.cos(inc) - np.sin(c) * math.sin(inc)
+    z = np.cos(c) * np.sin(u) * math.sin(inc) + np.sin(c) * math.cos(inc)
+    lat = np.degrees(np.arctan(np.tan(np.arcsin(z)) / (1 - WGS84_E2)))
+
+    # longitude: node of the path, position in the orbit, Earth rotation
+    node = WRS2_PATH1_NODE - (path[:, None] - 1) * 360 / WRS2_PATHS
+    lon = (node - 180 + 180 * WRS2_PERIOD / 1440 + np.degrees(np.arctan2(y, x))
+           - np.degrees(u) * WRS2_PERIOD / 1440)
+    # unwrap around the first corner
+    lon = lon[:, :1] + (lon - lon[:, :1] + 180) % 360 - 180
+    lon = lon - np.floor((lon.mean(axis=1, keepdims=True) + 180) / 360) * 360
+
+    names = ['%03d%03d' % pr for pr in zip(path, row)]
+    scenes = shapely.polygons(np.stack([lon, lat], axis=-1))
+    return _wrap(gpd.GeoDataFrame({'name': names}, geometry=scenes, crs='EPSG:4326'))
+
+
+
+def _wrap(grid):
+    """
+    Add a copy, shifted by 360 deg, of the footprints crossing the
+    antimeridian.
+    """
+    bounds = grid.bounds
+    west = grid[bounds['minx'] < -180].translate(360)
+    east = grid[bounds['maxx'] > 180].translate(-360)
+    extra = [gpd.GeoDataFrame({'name': grid.loc[s.index, 'name']}, geometry=s, crs=grid.crs)
+             for s in (west, east) if not s.empty]
+    return pd.concat([grid] + extra, ignore_index=True) if extra else grid
+
+
+
+def read_grid(grid_file, kind):
+    """
+    Read an official grid file: the Sentinel-2 tiling grid ('Name' column,
+    e.g. converted from the ESA KML) or the WRS-2 shapefile ('PATH' and
+    'ROW' columns).
+    """
+    gdf = gpd.read_file(grid_file).to_crs('EPSG:4326')
+    if kind == 'mgrs':
+        names = gdf['Name'].astype(str).str.lstrip('T')
+    else:
+        names = gdf['PATH'].astype(int).map('{:03d}'.format) + gdf['ROW'].astype(int).map('{:03d}'.format)
+    return gpd.GeoDataFrame({'name': names}, geometry=gdf.geometry.values, crs='EPSG:4326')
+
+
+
+def resolve_tiles(aoi, grid, min_overlap=0.0):
+    """
+    Names of the grid cells that intersect an AOI.
+
+    Parameters
+    ----------
+    aoi : shapely geometry
+        area of interest, in EPSG:4326
+    grid : gpd.GeoDataFrame
+        grid cells (name, geometry), e.g. from mgrs_grid or wrs2_grid
+    min_overlap : float, optional
+        minimum fraction of the AOI area that a cell must cover (computed
+        in EPSG:6933). Cells that barely touch the AOI are dropped.
+        Default is 0 (any intersection)
+
+    Returns
+    -------
+    names : list
+        sorted names of the intersecting cells
+    """
+    cells = grid.iloc[grid.sindex.query(aoi, predicate='intersects')]
+    if min_overlap and not cells.empty:
+        aoi_ea = gpd.GeoSeries([aoi], crs='EPSG:4326').to_crs('EPSG:6933').iloc[0]
+        overlap = cells.to_crs('EPSG:6933').intersection(aoi_ea).area / aoi_ea.area
+        cells = cells[(overlap >= min_overlap).to_numpy()]
+    return sorted(set(cells['name']))
+
+
+
+def aoi_tiles(shp, min_overlap=0.0, grid_file=None):
+    """
+    Sentinel-2 tiles (e.g. ['32TPS', '32TQS']) intersecting an AOI.
+
+    Parameters
+    ----------
+    shp : str or gpd.GeoDataFrame
+        AOI (shapefile path or GeoDataFrame)
+    min_overlap : float, optional
+        see resolve_tiles
+    grid_file : str, optional
+        official Sentinel-2 tiling grid, used instead of the computed grid
+    """
+    aoi = read_aoi(shp).union_all()
+    grid = read_grid(grid_file, 'mgrs') if grid_file else mgrs_grid(aoi.bounds)
+    return resolve_tiles(aoi, grid, min_overlap)
+
+
+
+def aoi_pathrows(shp, min_overlap=0.0, grid_file=None):
+    """
+    Landsat WRS-2 path/rows (e.g. ['192028', '193028']) intersecting an AOI.
+
+    Parameters
+    ----------
+    shp : str or gpd.GeoDataFrame
+        AOI (shapefile path or GeoDataFrame)
+    min_overlap : float, optional
+        see resolve_tiles
+    grid_file : str, optional
+        official WRS-2 shapefile (WRS2_descending), used instead of the
+        computed grid
+    """
+    aoi = read_aoi(shp).union_all()
+    grid = read_grid(grid_file, 'wrs2') if grid_file else wrs2_grid()
+    return resolve_tiles(aoi, grid, min_overlap)
@@ -0,0 +1,419 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 15:47:36 2026
+
+@author: vpremier
+"""
+
+import errno
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+def preallocate(file, size):
+    """
+    Reserve size bytes on disk for an open file (fallocate) before streaming
+    into it. This avoids running out of space in the middle of an archive
+    and reduces fragmentation on CEPH.
+    
+    A full disk (ENOSPC) raises an OSError; filesystems without fallocate
+    support are silently ignored.
+    """
+    if not size or not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        
+
+
+def plan_downloads(sizes, target_dir, reserve_bytes=0):
+    """
+    Compare the expected download volume with the free space of the target
+    filesystem. If everything does not fit, the queue is limited (in its 
+    original order) to the products that fit, keeping reserve_bytes free.
+
+    Parameters
+    ----------
+    sizes : list-like
+        expected size in bytes of each product (0 if already downloaded)
+    target_dir : str
+        folder on the target filesystem
+    reserve_bytes : int, optional
+        space to keep free. Default is 0
+
+    Returns
+    -------
+    keep : list
+        one bool per product: True if it fits and can be downloaded
+    """
+    sizes = [int(s) if s == s and s else 0 for s in sizes]   # NaN/None -> 0
+    
+    os.makedirs(target_dir, exist_ok=True)
+    free = shutil.disk_usage(target_dir).free - reserve_bytes
+    total = sum(sizes)
+    
+    print(f"Disk planning: {total / 1024**3:.1f} GB to download, "
+          f"{max(free, 0) / 1024**3:.1f} GB available")
+    
+    if total <= free:
+        return [True] * len(sizes)
+
+    keep = []
+    used = 0
+    for size in sizes:
+        fits = used + size <= free
+        keep.append(fits)
+        if fits:
+            used += size
+
+    print(f"⚠️ Warning: not enough disk space, {keep.count(False)} products "
+          f"postponed ({(total - used) / 1024**3:.1f} GB)")
+
+    return keep
+
+
+
+# smallest byte range worth a connection of its own
+MIN_SEGMENT_SIZE = 32 * 1024**2
+
+
+def fetch_to_file(response, open_range, filepath, segments=1, on_read=None,
+                  writer=None):
+    """
+    Save an HTTP download to filepath, optionally over several connections.
+
+    If segments > 1, the server accepts byte ranges and the file is large 
+    enough (MIN_SEGMENT_SIZE per segment), the file is split in byte 
+    ranges: the first one is read from response, the others are requested
+    in parallel with open_range and every range is written at its offset
+    into the preallocated file. Otherwise response is streamed as is.
+    
+    The data is written to filepath.part, renamed to filepath when complete,
+    so that an interrupted transfer never looks like a downloaded file.
+
+    Parameters
+    ----------
+    response : requests.Response
+        open (stream=True) response of the whole file
+    open_range : callable
+        open_range(start, end) returns an open (stream=True) response of 
+        the inclusive byte range [start, end]
+    filepath : str
+        output file
+    segments : int, optional
+        maximum number of parallel connections. Default is 1
+    on_read : callable, optional
+        called with the number of bytes of every chunk received
+    writer : DiskWriter, optional
+        writer stage: the chunks are queued and written by its threads, 
+        so that slow disk writes do not stall the network reads. If None,
+        every chunk is written by the thread that reads it
+
+    Returns
+    -------
+    size : int
+        number of bytes written
+    """
+    size = int(response.headers.get('Content-Length', 0))
+    ranged = (response.headers.get('Accept-Ranges', '').lower() == 'bytes' and 
+              'Content-Encoding' not in response.headers)
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE)) if ranged else 1
+    bounds = [size * k // segments for k in range(segments + 1)]
+    part_path = filepath + '.part'
+
+    def copy(stream, start, end):
+        # write stream (bytes start..end-1 of the file, or up to the end of
+        # the stream if end is None) at its offset
+        for chunk in stream.iter_content(chunk_size=1024 * 1024):
+            if not chunk:
+                continue
+            if end is not None:
+                chunk = chunk[:end - start]
+            sink.write(start, chunk)
+            start += len(chunk)
+            if on_read:
+                on_read(len(chunk))
+            if end is not None and start >= end:
+                break
+        if end is not None and start < end:
+            raise IOError(f"Incomplete range of {os.path.basename(filepath)}: "
+                          f"{end - start} bytes missing")
+
+    def fetch(start, end):
+        with open_range(start, end - 1) as stream:
+            stream.raise_for_status()
+            if stream.status_code != 206 or not stream.headers.get(
+                    'Content-Range', '').startswith(f'bytes {start}-'):
+                raise IOError(f"Range request ignored by the server: {os.path.basename(filepath)}")
+            copy(stream, start, end)
+
+    with open(part_path, 'wb') as f:
+        # reserve the space before streaming
+        preallocate(f, size)
+    sink = OutputFile(part_path, writer)
+
+    try:
+        try:
+            if segments > 1:
+                with ThreadPoolExecutor(max_workers=segments - 1) as pool:
+                    futures = [pool.submit(fetch, bounds[k], bounds[k + 1])
+                               for k in range(1, segments)]
+                    copy(response, 0, bounds[1])
+                    for future in futures:
+                        future.result()
+            else:
+                copy(response, 0, size or None)
+        finally:
+            # wait for the queued writes
+            sink.close()
+    except BaseException:
+        os.remove(part_path)
+        raise
+    finally:
+        response.close()
+
+    if size:
+        with open(part_path, 'r+b') as f:
+            f.truncate(size)
+    os.replace(part_path, filepath)
+    
+    return os.path.getsize(filepath)
+
+
+
+class OutputFile:
+    """
+    File written at given offsets, directly or through a DiskWriter.
+    Errors of the writer threads are raised by the next write() and by 
+    close().
+    """
+    def __init__(self, path, writer=None):
+        self.fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        self.writer = writer
+        self.pending = 0
+        self.error = None
+        self._lock = threading.Lock()
+
+    def write(self, offset, data):
+        if self.error is not None:
+            raise self.error
+        if self.writer is None:
+            self.pwrite(offset, data)
+        else:
+            self.writer.submit(self, offset, data)
+
+    def pwrite(self, offset, data):
+        view = memoryview(data)
+        if hasattr(os, 'pwrite'):
+            while view:
+                n = os.pwrite(self.fd, view, offset)
+                view, offset = view[n:], offset + n
+        else:
+            with self._lock:
+                os.lseek(self.fd, offset, os.SEEK_SET)
+                while view:
+                    view = view[os.write(self.fd, view):]
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.wait(self)
+        os.close(self.fd)
+        if self.error is not None:
+            raise self.error
+
+
+
+class DiskWriter:
+    """
+    Writer stage decoupled from the network reads. The downloads queue the
+    chunks they receive and return to the socket at once; writer threads 
+    drain the queue to disk. When the storage stalls (e.g. CEPH latency 
+    spikes) the queue absorbs up to buffer_mb MB before the readers block,
+    so the TCP window stays open.
+
+    Parameters
+    ----------
+    threads : int, optional
+        number of writer threads. Default is 2
+    buffer_mb : float, optional
+        maximum amount of queued data, in MB. Default is 256
+    """
+    def __init__(self, threads=2, buffer_mb=256):
+        self.max_buffer = int(buffer_mb * 1024**2)
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._buffered = 0
+        self._threads = [threading.Thread(target=self._run, daemon=True) 
+                         for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, target, offset, data):
+        """
+        Queue data to be written at offset of target (an OutputFile). Blocks
+        while the buffer is full.
+        """
+        with self._cond:
+            while self._buffered and self._buffered + len(data) > self.max_buffer:
+                self._cond.wait()
+            self._buffered += len(data)
+            target.pending += 1
+        self._queue.put((target, offset, data))
+
+    def wait(self, target):
+        """
+        Wait until the queued writes of target are on disk.
+        """
+        with self._cond:
+            while target.pending:
+                self._cond.wait()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            target, offset, data = item
+            try:
+                if target.error is None:
+                    target.pwrite(offset, data)
+            except Exception as e:
+                target.error = e
+            finally:
+                with self._cond:
+                    self._buffered -= len(data)
+                    target.pending -= 1
+                    self._cond.notify_all()
+
+    def close(self):
+        """
+        Write the queued data and stop the writer threads.
+        """
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+
+def is_throttled(error):
+    """
+    Whether a download error means that the server is overloaded: HTTP 429
+    or 5xx, or a connection error / timeout.
+    """
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, (requests.exceptions.ConnectionError, 
+                              requests.exceptions.Timeout))
+
+
+
+class ConcurrencyTuner:
+    """
+    Adaptive number of concurrent downloads (AIMD).
+
+    Every download holds a slot while it runs (``with tuner: ...``) and 
+    reports the bytes it receives with record(). Every `interval` seconds
+    the aggregate throughput is measured and the number of slots is:
+
+    - halved if a download failed with HTTP 429, 5xx or a connection error
+      (multiplicative decrease),
+    - decreased by one if the throughput fell by more than 10%,
+    - increased by one if all the slots were busy and the throughput 
+      improved by more than 5% (additive increase),
+
+    always within [min_workers, max_workers]. With min_workers == 
+    max_workers the concurrency is fixed.
+
+    Parameters
+    ----------
+    min_workers : int, optional
+        lowest concurrency. Default is 1
+    max_workers : int, optional
+        highest concurrency. Default is 8
+    start : int, optional
+        initial concurrency. Default is min_workers
+    interval : float, optional
+        measurement interval in seconds. Default is 10
+    label : str, optional
+        name used in the log messages
+    """
+    def __init__(self, min_workers=1, max_workers=8, start=None, interval=10,
+                 label='downloads'):
+        self.min_workers = min_workers
+        self.max_workers = max(max_workers, min_workers)
+        self.limit = min(max(start or min_workers, min_workers), self.max_workers)
+        self.interval = interval
+        self.label = label
+        self._cond = threading.Condition()
+        self._active = 0
+        self._bytes = 0
+        self._errors = 0
+        self._saturated = False
+        self._rate = None
+        self._start = time.monotonic()
+
+    def __enter__(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait(timeout=1)
+                self._tune()
+            self._active += 1
+            self._saturated = self._saturated or self._active >= self.limit
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with self._cond:
+            self._active -= 1
+            if exc is not None and is_throttled(exc):
+                self._errors += 1
+            self._tune()
+            self._cond.notify_all()
+        return False
+
+    def record(self, nbytes):
+        """
+        Count nbytes received by a download.
+        """
+        with self._cond:
+            self._bytes += nbytes
+            self._tune()
+
+    def _tune(self):
+        # called with the lock held
+        elapsed = time.monotonic() - self._start
+        if elapsed < self.interval:
+            return
+        
+        rate = self._bytes / elapsed
+        previous = limit = self.limit
+        if self._errors:
+            limit = max(self.min_workers, limit // 2)
+        elif self._rate is not None and rate < 0.9 * self._rate:
+            limit = max(self.min_workers, limit - 1)
+        elif self._saturated and (self._rate is None or rate > 1.05 * self._rate):
+            limit = min(self.max_workers, limit + 1)
+        
+        if limit != self.limit:
+            print(f"{self.label}: concurrency {self.limit} -> {limit} "
+                  f"({rate / 1024**2:.1f} MB/s, {self._errors} throttled)")
+            self.limit = limit
+            self._cond.notify_all()
+        
+        # after a decrease the throughput drops by construction: the next 
+        # interval starts a new comparison
+        self._rate = None if limit < previous else rate
+        self._bytes = 0
+        self._errors = 0
+        self._saturated = self._active >= self.limit
+        self._start = time.monotonic()
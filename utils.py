@@ -6,9 +6,16 @@ Created on Fri May 12 14:08:02 2023
 @author: vpremier
 """
 
+import hashlib
+import importlib.util
 import json
 import os
+import time
 from datetime import datetime
+from types import SimpleNamespace
+
+from download_queue import PRIORITIES
+from archive_audit import ACTIONS
 
 
 def load_config(config_path):
@@ -18,6 +25,111 @@ def load_config(config_path):
 
 
 
+def read_options(config):
+    """
+    Read the options of a run (single AOI or batch job) from a validated 
+    config, with their defaults.
+
+    Returns
+    -------
+    opts : types.SimpleNamespace
+        one attribute per option (e.g. opts.outdir, opts.landsat_bands)
+    """
+    max_runtime = config.get("max_runtime_min")
+    return SimpleNamespace(
+        # flags
+        landsat_query = config["query_landsat"],
+        sentinel2_query = config["query_sentinel2"],
+        landsat_download = config["download_landsat"],
+        sentinel2_download = config["download_sentinel2"],
+        
+        outdir = config["output_directory"],
+        shapefile = config.get("shapefile"),
+        date_start = config["date_start"],
+        date_end = config["date_end"],
+        max_cc = config["max_cloudcover"],
+        min_cover = config.get("min_cover_fraction"),
+        
+        # Landsat
+        landsat_satellite = config["landsat_satellite"],
+        landsat_tile_list = config["landsat_tile_list"],
+        landsat_workers = config.get("landsat_workers", 4),
+        landsat_bands = config.get("landsat_bands", []),
+        landsat_keep_tar = config.get("landsat_keep_tar", False),
+        landsat_backend = config.get("landsat_backend", "m2m"),
+        landsat_stac_url = config.get("landsat_stac_url"),
+        
+        # Sentinel-2
+        s2_tile_list = config["s2_tile_list"],
+        s2_bands = config.get("s2_bands", []),
+        s2_orbit_list = config.get("s2_orbit_list"),
+        s2_min_baseline = config.get("s2_min_baseline"),
+        
+        # transfers, storage and post-processing
+        store_dir = config.get("product_store"),
+        reserve_gb = config.get("disk_reserve_gb", 0),
+        concurrency = config.get("download_concurrency"),
+        segments = config.get("download_segments", 1),
+        disk_writer = config.get("disk_writer"),
+        extract = config.get("extract"),
+        audit = config.get("audit_archives"),
+        inventory_cache = config.get("inventory_cache", False),
+        
+        # local metadata catalog: filled by every query, or queried offline
+        catalog = config.get("catalog"),
+        offline = config.get("offline_query", False),
+        sync = config.get("sync", False),
+        
+        # download priority and budgets
+        priority = config.get("download_priority", "catalogue"),
+        preferred_missions = config.get("preferred_missions"),
+        max_gb = config.get("max_download_gb"),
+        max_products = config.get("max_products"),
+        deadline = time.time() + max_runtime * 60 if max_runtime else None,
+    )
+
+
+
+def load_sync_state(state_path):
+    """
+    Load the delta-sync watermarks (one per AOI and collection) saved by a
+    previous run. Returns an empty dict if there is no state yet.
+    """
+    if not os.path.isfile(state_path):
+        return {}
+    with open(state_path, 'r') as f:
+        state = json.load(f)
+    return state
+
+
+
+def save_sync_state(state_path, state):
+    """
+    Save the delta-sync watermarks. The file is replaced atomically, so an
+    interrupted run never leaves a truncated state behind.
+    """
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+
+def sync_key(shp, collection, query=None):
+    """
+    Key of the delta-sync watermark for an AOI (shapefile) and a collection.
+    If given, query (dict of the parameters that define the query: start
+    date, cloud cover, tiles...) is hashed into the key, so that the 
+    watermark of a run with other parameters is never applied.
+    """
+    key = f"{os.path.abspath(shp)}::{collection}"
+    if query:
+        digest = hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest()
+        key += f"::{digest[:12]}"
+    return key
+
+
+
 def check_config_consistency(config):
     """
     Validate required config fields for preprocessing.
@@ -35,12 +147,31 @@ def check_config_consistency(config):
     if not isinstance(outdir, str) or not outdir.strip():
         raise ValueError("'output_directory' must be a non-empty string.")
 
-    # Shapefile: must be string and not empty
-    shp = config.get("shapefile")
-    if not isinstance(shp, str) or not shp.strip():
-        raise ValueError("'shapefile' must be a non-empty string.")
-    if not os.path.isfile(shp):
-        raise ValueError(f"Shapefile path does not exist: '{shp}'")
+    # Batch job: list of AOIs, each with name, shapefile and output directory
+    aois = config.get("aois")
+    if aois is not None:
+        if not isinstance(aois, list) or not aois:
+            raise ValueError("'aois' must be a non-empty list.")
+        names = set()
+        for aoi in aois:
+            if not isinstance(aoi, dict):
+                raise ValueError("Each entry of 'aois' must be a dict.")
+            for key in ["name", "shapefile", "output_directory"]:
+                if not isinstance(aoi.get(key), str) or not aoi[key].strip():
+                    raise ValueError(f"AOI entries must have a non-empty string '{key}'.")
+            if aoi["name"] in names:
+                raise ValueError(f"Duplicated AOI name: '{aoi['name']}'")
+            names.add(aoi["name"])
+            if not os.path.isfile(aoi["shapefile"]):
+                raise ValueError(f"Shapefile path does not exist: '{aoi['shapefile']}'")
+
+    # Shapefile: must be string and not empty (not needed for batch jobs)
+    if aois is None:
+        shp = config.get("shapefile")
+        if not isinstance(shp, str) or not shp.strip():
+            raise ValueError("'shapefile' must be a non-empty string.")
+        if not os.path.isfile(shp):
+            raise ValueError(f"Shapefile path does not exist: '{shp}'")
 
     # Dates: must be string and valid dates
     date_start = config.get("date_start")
@@ -76,22 +207,155 @@ def check_config_consistency(config):
         if not isinstance(config[tile_key], list):
             raise ValueError(f"'{tile_key}' must be a list.")
 
+    # Optional: number of parallel Landsat downloads
+    landsat_workers = config.get("landsat_workers", 4)
+    if not isinstance(landsat_workers, int) or landsat_workers < 1:
+        raise ValueError("'landsat_workers' must be a positive integer.")
+
+    # Optional: tile lists resolved from the AOI (offline tile index)
+    if not isinstance(config.get("resolve_tiles", False), bool):
+        raise ValueError("'resolve_tiles' must be a boolean.")
+    min_overlap = config.get("tile_min_overlap", 0.0)
+    if isinstance(min_overlap, bool) or not isinstance(min_overlap, (int, float)) or \
+            not 0 <= min_overlap <= 1:
+        raise ValueError("'tile_min_overlap' must be a number in [0, 1].")
+    for key in ["mgrs_grid_file", "wrs2_grid_file"]:
+        grid_file = config.get(key)
+        if grid_file is not None and (not isinstance(grid_file, str) or not os.path.isfile(grid_file)):
+            raise ValueError(f"'{key}' must be an existing file: '{grid_file}'")
+
+    # Optional: Landsat tar members to extract while downloading
+    landsat_bands = config.get("landsat_bands", [])
+    if not isinstance(landsat_bands, list) or not all(isinstance(b, str) for b in landsat_bands):
+        raise ValueError("'landsat_bands' must be a list of glob patterns (e.g. '*_B3.TIF').")
+    if not isinstance(config.get("landsat_keep_tar", False), bool):
+        raise ValueError("'landsat_keep_tar' must be a boolean.")
+
+    # Optional: Landsat download backend (M2M tars or STAC band assets)
+    backend = config.get("landsat_backend", "m2m")
+    if backend not in ["m2m", "stac"]:
+        raise ValueError(f"Invalid 'landsat_backend': '{backend}'. Allowed: ['m2m', 'stac'].")
+    stac_url = config.get("landsat_stac_url")
+    if stac_url is not None and (not isinstance(stac_url, str) or not stac_url.startswith("http")):
+        raise ValueError("'landsat_stac_url' must be an http(s) URL.")
+
+    # Optional: Sentinel-2 SAFE files to retrieve instead of the full zip
+    s2_bands = config.get("s2_bands", [])
+    if not isinstance(s2_bands, list) or not all(isinstance(b, str) for b in s2_bands):
+        raise ValueError("'s2_bands' must be a list of glob patterns (e.g. '*_B03.jp2').")
 
+    # Optional: Sentinel-2 relative orbits and oldest processing baseline
+    orbits = config.get("s2_orbit_list")
+    if orbits is not None and (not isinstance(orbits, list) or 
+                               not all(isinstance(r, (str, int)) for r in orbits)):
+        raise ValueError("'s2_orbit_list' must be a list of relative orbits (e.g. 'R022' or 22).")
+    min_baseline = config.get("s2_min_baseline")
+    if min_baseline is not None and not isinstance(min_baseline, (str, int, float)):
+        raise ValueError("'s2_min_baseline' must be a baseline (e.g. 'N0500' or 5.0).")
 
-   
+    # Optional: delta sync
+    if not isinstance(config.get("sync", False), bool):
+        raise ValueError("'sync' must be a boolean.")
 
-    
+    # Optional: global product store shared by several output directories
+    store_dir = config.get("product_store")
+    if store_dir is not None and (not isinstance(store_dir, str) or not store_dir.strip()):
+        raise ValueError("'product_store' must be a non-empty string.")
 
+    # Optional: free space (GB) to keep on the output filesystem
+    reserve_gb = config.get("disk_reserve_gb", 0)
+    if isinstance(reserve_gb, bool) or not isinstance(reserve_gb, (int, float)) or reserve_gb < 0:
+        raise ValueError("'disk_reserve_gb' must be a non-negative number.")
 
+    # Optional: download priority and budgets
+    priority = config.get("download_priority", "catalogue")
+    if priority not in PRIORITIES:
+        raise ValueError(f"Invalid 'download_priority': '{priority}'. Allowed: {PRIORITIES}.")
+    preferred = config.get("preferred_missions")
+    if preferred is not None and (not isinstance(preferred, list) or 
+                                  not all(isinstance(m, str) for m in preferred)):
+        raise ValueError("'preferred_missions' must be a list of missions (e.g. 'S2B', 'LC09').")
+    for key in ["max_download_gb", "max_products", "max_runtime_min"]:
+        value = config.get(key)
+        if value is not None and (isinstance(value, bool) or 
+                                  not isinstance(value, (int, float)) or value <= 0):
+            raise ValueError(f"'{key}' must be a positive number.")
 
+    # Optional: adaptive number of parallel downloads
+    concurrency = config.get("download_concurrency")
+    if concurrency is not None:
+        if not isinstance(concurrency, dict):
+            raise ValueError("'download_concurrency' must be a dict with 'min', 'max' and 'start'.")
+        for key in ["min", "max", "start"]:
+            value = concurrency.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+                raise ValueError(f"'download_concurrency.{key}' must be a positive integer.")
+        if concurrency.get("min", 1) > concurrency.get("max", 8):
+            raise ValueError("'download_concurrency.min' must not exceed 'download_concurrency.max'.")
 
+    # Optional: parallel connections (byte ranges) per archive
+    segments = config.get("download_segments", 1)
+    if isinstance(segments, bool) or not isinstance(segments, int) or segments < 1:
+        raise ValueError("'download_segments' must be a positive integer.")
 
+    # Optional: disk writes decoupled from the network reads
+    disk_writer = config.get("disk_writer")
+    if disk_writer is not None:
+        if not isinstance(disk_writer, dict):
+            raise ValueError("'disk_writer' must be a dict with 'threads' and 'buffer_mb'.")
+        threads = disk_writer.get("threads", 2)
+        if isinstance(threads, bool) or not isinstance(threads, int) or threads < 1:
+            raise ValueError("'disk_writer.threads' must be a positive integer.")
+        buffer_mb = disk_writer.get("buffer_mb", 256)
+        if isinstance(buffer_mb, bool) or not isinstance(buffer_mb, (int, float)) or buffer_mb <= 0:
+            raise ValueError("'disk_writer.buffer_mb' must be a positive number.")
 
+    # Optional: cached inventory of the output directory
+    if not isinstance(config.get("inventory_cache", False), bool):
+        raise ValueError("'inventory_cache' must be a boolean.")
 
+    # Optional: integrity audit of the existing archives
+    audit = config.get("audit_archives")
+    if audit is not None and audit not in ACTIONS:
+        raise ValueError(f"Invalid 'audit_archives': '{audit}'. Allowed: {ACTIONS}.")
 
+    # Optional: cooperative downloading through a shared work queue
+    queue_config = config.get("work_queue")
+    if queue_config is not None:
+        if not isinstance(queue_config, dict) or not isinstance(queue_config.get("directory"), str):
+            raise ValueError("'work_queue' must be a dict with a 'directory' string.")
+        for key in ["lease_minutes", "batch_size"]:
+            value = queue_config.get(key, 1)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f"'work_queue.{key}' must be a positive number.")
 
+    # Optional: minimal set of scenes covering the AOI per acquisition
+    min_cover = config.get("min_cover_fraction")
+    if min_cover is not None and (isinstance(min_cover, bool) or 
+                                  not isinstance(min_cover, (int, float)) or 
+                                  not 0 < min_cover <= 1):
+        raise ValueError("'min_cover_fraction' must be a number in (0, 1].")
 
-          
-            
+    # Optional: local GeoParquet metadata catalog (needs pyarrow)
+    catalog = config.get("catalog")
+    if catalog is not None:
+        if not isinstance(catalog, str) or not catalog.strip():
+            raise ValueError("'catalog' must be a non-empty string.")
+        if importlib.util.find_spec("pyarrow") is None:
+            raise ValueError("'catalog' requires the pyarrow package (pip install pyarrow).")
+    if not isinstance(config.get("offline_query", False), bool):
+        raise ValueError("'offline_query' must be a boolean.")
+    if config.get("offline_query") and catalog is None:
+        raise ValueError("'offline_query' requires a 'catalog'.")
 
-  
+    # Optional: extraction of the archives while downloading
+    extract = config.get("extract")
+    if extract is not None:
+        if not isinstance(extract, dict):
+            raise ValueError("'extract' must be a dict with 'workers' and 'delete_archives'.")
+        workers = extract.get("workers", 1)
+        if workers is not None and (isinstance(workers, bool) or 
+                                    not isinstance(workers, int) or workers < 1):
+            raise ValueError("'extract.workers' must be a positive integer.")
+        if not isinstance(extract.get("delete_archives", False), bool):
+            raise ValueError("'extract.delete_archives' must be a boolean.")
@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 09:40:17 2026
+
+@author: vpremier
+"""
+
+import hashlib
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+
+# Work queue on a shared filesystem (e.g. the CEPH output directory), used to
+# split the downloads between several processes on one or more hosts.
+#
+# Layout of a queue folder:
+#     manifest.json        written once the queue is completely published,
+#                          with the query parameters of the products
+#     items/KEY.json       one product per file
+#     locks/KEY.lock       lease of the worker that claimed the product (with
+#                          a unique token of the claim)
+#     done/KEY             product downloaded
+#     failed/KEY           number of failed attempts
+#
+# A lease expires when its lock file has not been touched for lease_seconds:
+# the product can then be claimed by another worker. Only the worker holding
+# the token of a lock renews or removes it.
+
+
+def _write_atomic(path, text):
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+
+
+def queue_path(root, name, query):
+    """
+    Queue folder of a query: root/NAME-HASH, where HASH identifies the query
+    parameters (dict). A different query gets a new queue.
+    """
+    digest = hashlib.sha1(json.dumps(query, sort_keys=True).encode()).hexdigest()
+    return os.path.join(root, f"{name}-{digest[:12]}")
+
+
+
+def _read_manifest(queue_dir):
+    try:
+        with open(os.path.join(queue_dir, 'manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+
+def _check_query(queue_dir, manifest, query):
+    # JSON round trip: tuples and lists compare equal
+    if query is not None and manifest.get('query') != json.loads(json.dumps(query)):
+        raise ValueError(f"Work queue {queue_dir} was published for another query: "
+                         f"{manifest.get('query')}")
+
+
+
+def is_published(queue_dir, query=None):
+    """
+    Whether a queue has been completely published in queue_dir. If query is
+    given, a queue published for other query parameters raises a ValueError.
+    """
+    manifest = _read_manifest(queue_dir)
+    if manifest is None:
+        return False
+    _check_query(queue_dir, manifest, query)
+    return True
+
+
+
+def publish_queue(queue_dir, items, key, query=None):
+    """
+    Publish a list of products as a work queue. Publishing is idempotent:
+    products already in the queue are left unchanged, so several hosts can 
+    publish the same query result. Publishing the products of another query
+    in the same queue_dir raises a ValueError.
+
+    Parameters
+    ----------
+    queue_dir : str
+        queue folder on the shared filesystem
+    items : list
+        products (JSON-serializable dicts)
+    key : str
+        field of the items used as unique key (e.g. 'Name' or 'displayId')
+    query : dict, optional
+        query parameters of the products (dates, AOI, collection, tiles...),
+        saved in the manifest
+
+    Returns
+    -------
+    n_new : int
+        number of products added to the queue
+    """
+    manifest = _read_manifest(queue_dir)
+    if manifest is not None:
+        _check_query(queue_dir, manifest, query)
+
+    for sub in ['items', 'locks', 'done', 'failed']:
+        os.makedirs(os.path.join(queue_dir, sub), exist_ok=True)
+
+    n_new = 0
+    for item in items:
+        path = os.path.join(queue_dir, 'items', item[key] + '.json')
+        if os.path.exists(path):
+            continue
+        _write_atomic(path, json.dumps(item))
+        n_new += 1
+
+    manifest = {'key': key,
+                'query': query,
+                'n_items': len(items),
+                'host': socket.gethostname(),
+                'published': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    _write_atomic(os.path.join(queue_dir, 'manifest.json'), json.dumps(manifest, indent=2))
+
+    print(f"Work queue {queue_dir}: {n_new} products published "
+          f"({len(items) - n_new} already queued)")
+
+    return n_new
+
+
+
+def load_queue(queue_dir):
+    """
+    Load the products of a published queue, as a dict KEY -> item.
+    """
+    items = {}
+    items_dir = os.path.join(queue_dir, 'items')
+    with os.scandir(items_dir) as entries:
+        for entry in entries:
+            if entry.name.endswith('.json'):
+                with open(entry.path) as f:
+                    items[entry.name[:-len('.json')]] = json.load(f)
+    return items
+
+
+
+def _lock_token(lock):
+    # token of the claim holding a lock, None if there is no (valid) lock
+    try:
+        with open(lock) as f:
+            return json.load(f).get('token')
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+
+def claim(queue_dir, key, lease_seconds):
+    """
+    Try to claim a product: create its lock file atomically (O_EXCL), or 
+    take over an expired lease.
+
+    Returns
+    -------
+    token : str or None
+        unique token of the claim (needed by renew and release), None if
+        the product is claimed by another worker
+    """
+    lock = os.path.join(queue_dir, 'locks', key + '.lock')
+    token = uuid.uuid4().hex
+    owner = json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'token': token})
+
+    for _ in range(2):
+        try:
+            fd = os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            with os.fdopen(fd, 'w') as f:
+                f.write(owner)
+            return token
+        except FileExistsError:
+            pass
+
+        # expired lease: the lock is renamed to a name of this claim, then
+        # checked again (another worker may have taken it over, or the 
+        # owner renewed it, in the meantime) before a new lock is created
+        try:
+            if time.time() - os.stat(lock).st_mtime < lease_seconds:
+                return None
+            expired = _lock_token(lock)
+            stale = f"{lock}.{token}.stale"
+            os.rename(lock, stale)
+        except FileNotFoundError:
+            continue
+
+        if (time.time() - os.stat(stale).st_mtime < lease_seconds
+                or _lock_token(stale) != expired):
+            # not the expired lock: put it back, unless a new one exists
+            try:
+                os.link(stale, lock)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return None
+        os.remove(stale)
+
+    return None
+
+
+
+def renew(queue_dir, key, token):
+    """
+    Renew the lease of a claimed product. Returns False if the lease was 
+    lost (lock removed or taken over by another worker).
+    """
+    lock = os.path.join(queue_dir, 'locks', key + '.lock')
+    if _lock_token(lock) != token:
+        return False
+    try:
+        os.utime(lock)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+
+def _unlock(queue_dir, key, token):
+    # remove a lock, only if it still belongs to the claim
+    lock = os.path.join(queue_dir, 'locks', key + '.lock')
+    if _lock_token(lock) != token:
+        return
+    try:
+        os.remove(lock)
+    except FileNotFoundError:
+        pass
+
+
+
+def release(queue_dir, key, token, status='done'):
+    """
+    Release a claimed product. status is 'done', 'failed' (a failed attempt
+    is counted) or 'postponed' (not attempted: the product stays in the
+    queue, without counting an attempt). The lock is removed only if it 
+    still holds token.
+    """
+    if status == 'done':
+        open(os.path.join(queue_dir, 'done', key), 'w').close()
+    elif status == 'failed':
+        failed = os.path.join(queue_dir, 'failed', key)
+        attempts = failed_attempts(queue_dir, key) + 1
+        _write_atomic(failed, str(attempts))
+    _unlock(queue_dir, key, token)
+
+
+
+def failed_attempts(queue_dir, key):
+    """
+    Number of failed download attempts of a product.
+    """
+    try:
+        with open(os.path.join(queue_dir, 'failed', key)) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+
+def run_worker(queue_dir, handler, batch_size=1, lease_seconds=900,
+               max_attempts=3, poll_seconds=30):
+    """
+    Claim and process products of a work queue until none is left. Any 
+    number of workers, on any host mounting queue_dir, can run at once.
+
+    Parameters
+    ----------
+    queue_dir : str
+        queue folder on the shared filesystem
+    handler : callable
+        handler(items) downloads a list of products and returns two lists
+        of keys: the products that failed and the products postponed (not
+        attempted: deadline, budgets or disk reserve). Postponed products 
+        may also be listed as failed; they are released without counting 
+        an attempt, and not claimed again by this worker
+    batch_size : int, optional
+        number of products claimed (and passed to handler) at once
+    lease_seconds : float, optional
+        lease duration. Leases are renewed every lease_seconds/3 while the
+        handler runs. Default is 900 (15 minutes)
+    max_attempts : int, optional
+        products that failed max_attempts times are not retried. Default is 3
+    poll_seconds : float, optional
+        waiting time when all remaining products are claimed by other workers
+
+    Returns
+    -------
+    n_done : int
+        number of products processed successfully by this worker
+    """
+    items = load_queue(queue_dir)
+    done_dir = os.path.join(queue_dir, 'done')
+    locks_dir = os.path.join(queue_dir, 'locks')
+
+    claimed = {}
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            for key, token in list(claimed.items()):
+                if not renew(queue_dir, key, token):
+                    print(f"Lease lost for {key}")
+
+    thread = threading.Thread(target=heartbeat, daemon=True)
+    thread.start()
+
+    n_done = 0
+    skipped = set()     # postponed by this worker
+    try:
+        while True:
+            done = set(os.listdir(done_dir))
+            pending = [k for k in items if k not in done and k not in skipped
+                       and failed_attempts(queue_dir, k) < max_attempts]
+            if not pending:
+                break
+
+            # random order: concurrent workers rarely compete for the same product
+            random.shuffle(pending)
+            batch = {}
+            for key in pending:
+                token = claim(queue_dir, key, lease_seconds)
+                if token is None:
+                    continue
+                # done by another worker since the listing (done/ is written 
+                # before the lock is removed)
+                if os.path.exists(os.path.join(done_dir, key)):
+                    _unlock(queue_dir, key, token)
+                    continue
+                batch[key] = token
+                if len(batch) == batch_size:
+                    break
+
+            if not batch:
+                locked = {f[:-len('.lock')] for f in os.listdir(locks_dir) if f.endswith('.lock')}
+                if not locked.intersection(pending):
+                    break
+                time.sleep(poll_seconds)
+                continue
+
+            claimed.update(batch)
+            try:
+                failed, postponed = handler([items[k] for k in batch]) or ([], [])
+                failed, postponed = set(failed), set(postponed)
+            except Exception as e:
+                print(f"Worker error: {e}")
+                failed, postponed = set(batch), set()
+
+            for key, token in batch.items():
+                if key in postponed:
+                    status = 'postponed'
+                elif key in failed:
+                    status = 'failed'
+                else:
+                    status = 'done'
+                release(queue_dir, key, token, status)
+                del claimed[key]
+            n_done += len(set(batch) - failed - postponed)
+            skipped.update(postponed.intersection(batch))
+    finally:
+        stop.set()
+
+    print(f"Worker {socket.gethostname()}:{os.getpid()} processed {n_done} products"
+          + (f" ({len(skipped)} postponed)" if skipped else ""))
+
+    return n_done